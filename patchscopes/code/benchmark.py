@@ -0,0 +1,426 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks of patchscopes on tiny randomly initialized models.
+
+Usage:
+python3 benchmark.py --archs gptj llama neox --batch_sizes 8 32 \
+    --seq_lens 16 64 --output benchmark.json
+
+The models and tokenizer are built locally (nothing is downloaded), so the
+timings only compare the patchscopes code between commits, not models.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import tokenizers
+import torch
+import transformers
+from general_utils import BatchProgress
+from general_utils import make_inputs
+from general_utils import ModelAndTokenizer
+from patchscopes_utils import evaluate_attriburte_exraction_batch
+from patchscopes_utils import evaluate_patch_next_token_prediction_batch
+from patchscopes_utils import inspect
+from patchscopes_utils import inspect_batch
+from patchscopes_utils import remove_hooks
+from patchscopes_utils import set_hs_patch_hooks
+from patchscopes_utils import set_hs_patch_hooks_batch
+from profile_utils import HookProfiler
+
+
+BENCHMARKS = (
+    "inspect",
+    "inspect_batch",
+    "evaluate_patch_next_token_prediction_batch",
+    "evaluate_attriburte_exraction_batch",
+    "patch_hooks",
+)
+
+_SPECIAL_TOKENS = ("<unk>", "<bos>", "<eos>", "[PAD]")
+
+
+def make_tiny_tokenizer(vocab_size=512):
+  """A whitespace word-level tokenizer over the words w0, w1, ..."""
+  vocab = {token: i for i, token in enumerate(_SPECIAL_TOKENS)}
+  for i in range(vocab_size - len(vocab)):
+    vocab[f"w{i}"] = len(vocab)
+  tokenizer = tokenizers.Tokenizer(
+      tokenizers.models.WordLevel(vocab, unk_token="<unk>")
+  )
+  tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+  tokenizer.decoder = tokenizers.decoders.WordPiece()
+  return transformers.PreTrainedTokenizerFast(
+      tokenizer_object=tokenizer,
+      unk_token="<unk>",
+      bos_token="<bos>",
+      eos_token="<eos>",
+      pad_token="[PAD]",
+  )
+
+
+def make_tiny_config(
+    arch, vocab_size=512, hidden_size=64, num_layers=4, num_heads=4,
+    max_positions=512,
+):
+  """A small config of arch ("gptj", "llama" or "neox")."""
+  special_ids = dict(bos_token_id=1, eos_token_id=2, pad_token_id=3)
+  if arch == "gptj":
+    return transformers.GPTJConfig(
+        vocab_size=vocab_size,
+        n_positions=max_positions,
+        n_embd=hidden_size,
+        n_layer=num_layers,
+        n_head=num_heads,
+        rotary_dim=hidden_size // num_heads // 2,
+        **special_ids,
+    )
+  elif arch == "llama":
+    return transformers.LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        max_position_embeddings=max_positions,
+        **special_ids,
+    )
+  elif arch == "neox":
+    return transformers.GPTNeoXConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        max_position_embeddings=max_positions,
+        **special_ids,
+    )
+  else:
+    raise ValueError("Architecture %s not supported" % arch)
+
+
+def make_tiny_mt(arch, device="cpu", seed=0, **config_kwargs):
+  """A ModelAndTokenizer of a randomly initialized model of arch."""
+  torch.manual_seed(seed)
+  config = make_tiny_config(arch, **config_kwargs)
+  tokenizer = make_tiny_tokenizer(config.vocab_size)
+  model = transformers.AutoModelForCausalLM.from_config(config)
+  model.to(device)
+  model.eval()
+  model.requires_grad_(False)
+  return ModelAndTokenizer(model=model, tokenizer=tokenizer, device=device)
+
+
+def make_benchmark_df(mt, n_rows, seq_len, max_gen_len=8, seed=0):
+  """Random prompts of about seq_len tokens, with the batch columns."""
+  rng = np.random.default_rng(seed)
+  num_words = len(mt.tokenizer) - len(_SPECIAL_TOKENS)
+
+  def _prompts():
+    # Lengths vary, so batches are padded as in real data.
+    lengths = rng.integers(max(seq_len // 2, 1), seq_len + 1, size=n_rows)
+    return [
+        " ".join(f"w{w}" for w in rng.integers(num_words, size=length))
+        for length in lengths
+    ]
+
+  return pd.DataFrame({
+      "prompt_source": _prompts(),
+      "prompt_target": _prompts(),
+      "layer_source": rng.integers(mt.num_layers, size=n_rows),
+      "layer_target": rng.integers(mt.num_layers, size=n_rows),
+      "position_source": -1,
+      "position_target": -1,
+      "max_gen_len": rng.integers(1, max_gen_len + 1, size=n_rows),
+      "object": "w0",
+  })
+
+
+def _synchronize(mt):
+  if torch.device(mt.device).type == "cuda":
+    torch.cuda.synchronize()
+
+
+def _rss_mb():
+  """The current resident memory of the process."""
+  if os.path.exists("/proc/self/statm"):
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+  # ru_maxrss (in kilobytes on Linux) is the peak of the process lifetime.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _PeakMemory:
+  """Records the peak memory of the calls made within the context.
+
+  On CUDA, this is the peak allocated memory. On the CPU, the resident memory
+  of the process is sampled every `interval_s` from a thread.
+  """
+
+  def __init__(self, mt, interval_s=0.005):
+    self.is_cuda = torch.device(mt.device).type == "cuda"
+    self.interval_s = interval_s
+    self.peak_mb = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _sample(self):
+    while not self._stop.wait(self.interval_s):
+      self.peak_mb = max(self.peak_mb, _rss_mb())
+
+  def __enter__(self):
+    if self.is_cuda:
+      torch.cuda.reset_peak_memory_stats()
+    else:
+      self.peak_mb = _rss_mb()
+      self._thread = threading.Thread(target=self._sample, daemon=True)
+      self._thread.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    if self.is_cuda:
+      self.peak_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+      self._stop.set()
+      self._thread.join()
+      self.peak_mb = max(self.peak_mb, _rss_mb())
+
+
+def time_call(mt, fn, repeats=3, warmup=1):
+  """Runs fn warmup + repeats times, returns the timings of the repeats."""
+  for _ in range(warmup):
+    fn()
+  times = []
+  with _PeakMemory(mt) as peak_memory:
+    for _ in range(repeats):
+      _synchronize(mt)
+      start_time = time.perf_counter()
+      fn()
+      _synchronize(mt)
+      times.append(time.perf_counter() - start_time)
+  return {
+      "time_s": float(np.median(times)),
+      "min_time_s": float(np.min(times)),
+      "peak_memory_mb": peak_memory.peak_mb,
+  }
+
+
+def _benchmark_calls(mt, df, batch_size, max_gen_len):
+  """Maps each benchmark to a (number of rows, function) pair."""
+  row = df.iloc[0]
+
+  def _inspect():
+    mt.set_hs_patch_hooks = set_hs_patch_hooks
+    inspect(
+        mt,
+        row["prompt_source"],
+        row["prompt_target"],
+        int(row["layer_source"]),
+        int(row["layer_target"]),
+        -1,
+        -1,
+        generation_mode=True,
+        max_gen_len=max_gen_len,
+    )
+
+  def _inspect_batch():
+    inspect_batch(mt, df, batch_size=batch_size, progress=BatchProgress())
+
+  def _next_token_batch():
+    evaluate_patch_next_token_prediction_batch(
+        mt, df, batch_size=batch_size, progress=BatchProgress()
+    )
+
+  def _attribute_extraction_batch():
+    evaluate_attriburte_exraction_batch(
+        mt,
+        df,
+        batch_size=batch_size,
+        max_gen_len=max_gen_len,
+        is_icl=False,
+        progress=BatchProgress(),
+    )
+
+  return {
+      "inspect": (1, _inspect),
+      "inspect_batch": (len(df), _inspect_batch),
+      "evaluate_patch_next_token_prediction_batch": (
+          len(df), _next_token_batch
+      ),
+      "evaluate_attriburte_exraction_batch": (
+          len(df), _attribute_extraction_batch
+      ),
+  }
+
+
+def benchmark_hook_overhead(mt, df, batch_size, repeats=3):
+  """Times a forward pass on a batch with and without the patch hooks.
+
+  Every row is patched at its target layer and last position, with zeros,
+  so the difference is the cost of dispatching and applying the hooks.
+  """
+  batch_df = df.iloc[:batch_size]
+  inputs = make_inputs(mt.tokenizer, batch_df["prompt_target"], mt.device)
+  hidden_size = mt.model.config.hidden_size
+  hs_patch_config = [
+      {
+          "batch_idx": i,
+          "layer_target": layer,
+          "position_target": inputs["input_ids"].shape[1] - 1,
+          "hidden_rep": torch.zeros(hidden_size, device=mt.device),
+          "skip_final_ln": False,
+      }
+      for i, layer in enumerate(batch_df["layer_target"])
+  ]
+  plain = time_call(mt, lambda: mt.model(**inputs), repeats)
+
+  def _patched():
+    hooks = set_hs_patch_hooks_batch(mt.model, hs_patch_config)
+    try:
+      mt.model(**inputs)
+    finally:
+      remove_hooks(hooks)
+
+  patched = time_call(mt, _patched, repeats)
+  return dict(
+      patched,
+      rows=len(batch_df),
+      plain_time_s=plain["time_s"],
+      hook_overhead_s=patched["time_s"] - plain["time_s"],
+  )
+
+
+def run_benchmarks(
+    archs=("gptj", "llama", "neox"),
+    batch_sizes=(8, 32),
+    seq_lens=(16, 64),
+    n_rows=64,
+    max_gen_len=8,
+    repeats=3,
+    benchmarks=BENCHMARKS,
+    device="cpu",
+    **config_kwargs,
+):
+  """Runs the benchmarks over every (arch, batch size, sequence length).
+
+  Returns:
+    A list of records with the "arch", "benchmark", "batch_size", "seq_len",
+    the number of "rows" per call, the median "time_s" (and "min_time_s")
+    of a call, the "rows_per_s" and the "peak_memory_mb" during the calls
+    (allocated CUDA memory, or resident memory on the CPU). Records of
+    "patch_hooks" also hold the "plain_time_s" of the forward pass without
+    hooks and the "hook_overhead_s".
+  """
+  records = []
+  for arch in archs:
+    mt = make_tiny_mt(arch, device=device, **config_kwargs)
+    for seq_len in seq_lens:
+      df = make_benchmark_df(mt, n_rows, seq_len, max_gen_len)
+      for batch_size in batch_sizes:
+        calls = _benchmark_calls(mt, df, batch_size, max_gen_len)
+        for name in benchmarks:
+          with torch.no_grad():
+            if name == "patch_hooks":
+              record = benchmark_hook_overhead(mt, df, batch_size, repeats)
+            else:
+              rows, fn = calls[name]
+              record = dict(time_call(mt, fn, repeats), rows=rows)
+          record.update(
+              arch=arch,
+              benchmark=name,
+              batch_size=batch_size,
+              seq_len=seq_len,
+              rows_per_s=record["rows"] / record["time_s"],
+          )
+          records.append(record)
+  return records
+
+
+def _git_commit():
+  try:
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        capture_output=True, text=True, check=True,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--archs", nargs="+", default=["gptj", "llama", "neox"])
+  parser.add_argument("--batch_sizes", nargs="+", type=int, default=[8, 32])
+  parser.add_argument("--seq_lens", nargs="+", type=int, default=[16, 64])
+  parser.add_argument("--n_rows", default=64, type=int)
+  parser.add_argument("--max_gen_len", default=8, type=int)
+  parser.add_argument("--repeats", default=3, type=int)
+  parser.add_argument(
+      "--benchmarks", nargs="+", default=list(BENCHMARKS), choices=BENCHMARKS
+  )
+  parser.add_argument("--device", default="cpu", type=str)
+  parser.add_argument("--num_layers", default=4, type=int)
+  parser.add_argument("--hidden_size", default=64, type=int)
+  parser.add_argument(
+      "--output", default=None, type=str,
+      help="Path of the JSON report, printed if not given.",
+  )
+  parser.add_argument(
+      "--trace", default=None, type=str,
+      help="Path of a Chrome trace of the hooks and batch stages. Profiling "
+      "also adds a per-hook report, and slows the timed calls down.",
+  )
+
+  args = parser.parse_args()
+  profiler = HookProfiler() if args.trace is not None else None
+  with profiler or contextlib.nullcontext():
+    results = run_benchmarks(
+        archs=args.archs,
+        batch_sizes=args.batch_sizes,
+        seq_lens=args.seq_lens,
+        n_rows=args.n_rows,
+        max_gen_len=args.max_gen_len,
+        repeats=args.repeats,
+        benchmarks=args.benchmarks,
+        device=args.device,
+        num_layers=args.num_layers,
+        hidden_size=args.hidden_size,
+    )
+  report = {
+      "commit": _git_commit(),
+      "python": platform.python_version(),
+      "torch": torch.__version__,
+      "transformers": transformers.__version__,
+      "device": args.device,
+      "args": vars(args),
+      "results": results,
+  }
+  if profiler is not None:
+    report["profile"] = profiler.report()
+    profiler.chrome_trace(args.trace)
+  if args.output is None:
+    print(json.dumps(report, indent=2))
+  else:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
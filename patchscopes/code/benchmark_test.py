@@ -0,0 +1,47 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Smoke test of the benchmark script over its default architectures."""
+
+import json
+import unittest
+
+from benchmark import BENCHMARKS
+from benchmark import run_benchmarks
+
+
+class RunBenchmarksTest(unittest.TestCase):
+
+  def test_every_arch_and_benchmark_reports(self):
+    archs = ("gptj", "llama", "neox")
+    records = run_benchmarks(
+        archs=archs,
+        batch_sizes=(4,),
+        seq_lens=(8,),
+        n_rows=8,
+        max_gen_len=2,
+        repeats=1,
+    )
+    self.assertEqual(
+        {(r["arch"], r["benchmark"]) for r in records},
+        {(arch, name) for arch in archs for name in BENCHMARKS},
+    )
+    for record in json.loads(json.dumps(records)):
+      self.assertGreater(record["time_s"], 0)
+      self.assertGreater(record["peak_memory_mb"], 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,246 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed caches of source hidden states and target prefixes."""
+
+import collections
+import hashlib
+import os
+
+import numpy as np
+import torch
+from general_utils import encode_prompts
+from general_utils import make_inputs
+from general_utils import model_id
+
+
+class HiddenStateCache:
+  """A memory-bounded LRU cache of the hidden states of source prompts.
+
+  Entries are keyed by the model id and the tokenized source prompt, and hold
+  the residuals of all layers for that prompt (the `hidden_states` returned
+  with `output_hidden_states=True`, without padding). Rows that share a source
+  prompt therefore pay for a single forward pass, whatever layer and position
+  they read from. Entries evicted from memory are spilled to `cache_dir` (if
+  given) and reloaded from there on the next lookup.
+
+  Positions index into the unpadded source prompt, so negative positions are
+  the same as in the uncached batch evaluators.
+  """
+
+  def __init__(
+      self,
+      mt,
+      max_bytes=2**30,
+      cache_dir=None,
+      storage_device="cpu",
+      batch_size=32,
+  ):
+    self.mt = mt
+    self.max_bytes = max_bytes
+    self.cache_dir = cache_dir
+    self.storage_device = storage_device
+    self.batch_size = batch_size
+    # The id tells apart e.g. a model and its int8 quantized copy, which
+    # share a path and dtype, so that they can share cache_dir.
+    self.model_id = model_id(mt.model)
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+    self._entries = collections.OrderedDict()
+    self._num_bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __repr__(self):
+    return (
+        f"HiddenStateCache({len(self)} entries, "
+        f"{self._num_bytes / 2**20:.1f}MB, "
+        f"hits: {self.hits}, misses: {self.misses})"
+    )
+
+  def key(self, token_ids):
+    """Content address of a tokenized prompt for this model."""
+    digest = hashlib.sha1(self.model_id.encode("utf-8"))
+    digest.update(np.asarray(token_ids, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+  def _spill_path(self, key):
+    return os.path.join(self.cache_dir, f"{key}.pt")
+
+  def _put(self, key, states):
+    num_bytes = states.numel() * states.element_size()
+    if num_bytes > self.max_bytes:
+      if self.cache_dir is not None:
+        self._spill(key, states)
+      return
+    self._entries[key] = states
+    self._num_bytes += num_bytes
+    while self._num_bytes > self.max_bytes:
+      old_key, old_states = self._entries.popitem(last=False)
+      self._num_bytes -= old_states.numel() * old_states.element_size()
+      if self.cache_dir is not None:
+        self._spill(old_key, old_states)
+
+  def _spill(self, key, states):
+    path = self._spill_path(key)
+    if not os.path.exists(path):
+      torch.save(states, path + ".tmp")
+      os.replace(path + ".tmp", path)
+
+  def _get(self, key):
+    if key in self._entries:
+      self._entries.move_to_end(key)
+      return self._entries[key]
+    if self.cache_dir is not None and os.path.exists(self._spill_path(key)):
+      states = torch.load(
+          self._spill_path(key), map_location=self.storage_device
+      )
+      self._put(key, states)
+      return states
+    return None
+
+  def _compute(self, prompts):
+    """Runs the source prompts through the model, returns unpadded states."""
+    inp = make_inputs(self.mt.tokenizer, prompts, self.mt.device)
+    # Position ids that ignore the left padding, so that the cached states of
+    # a prompt do not depend on the other prompts it was batched with.
+    position_ids = inp["attention_mask"].long().cumsum(-1) - 1
+    position_ids.masked_fill_(inp["attention_mask"] == 0, 1)
+    output = self.mt.model(
+        **inp, position_ids=position_ids, output_hidden_states=True
+    )
+    lengths = inp["attention_mask"].sum(-1).tolist()
+    return [
+        torch.stack([hs[i, -lengths[i] :] for hs in output.hidden_states]).to(
+            self.storage_device
+        )
+        for i in range(len(prompts))
+    ]
+
+  def lookup(self, prompts):
+    """Returns the cached states of each prompt, computing the missing ones.
+
+    Args:
+      prompts: a sequence of source prompts, possibly with repetitions.
+
+    Returns:
+      A list with a (num_layers + 1, seq_len, hidden_dim) tensor per prompt.
+    """
+    keys = [
+        self.key(t) for t in encode_prompts(self.mt.tokenizer, prompts)
+    ]
+    found = {}
+    missing = {}
+    for prompt, key in zip(prompts, keys):
+      if key in found or key in missing:
+        continue
+      states = self._get(key)
+      if states is None:
+        missing[key] = prompt
+      else:
+        found[key] = states
+    self.misses += len(missing)
+    self.hits += len(keys) - len(missing)
+
+    missing = list(missing.items())
+    for i in range(0, len(missing), self.batch_size):
+      chunk = missing[i : i + self.batch_size]
+      for (key, _), states in zip(
+          chunk, self._compute([p for _, p in chunk])
+      ):
+        found[key] = states
+        self._put(key, states)
+    return [found[key] for key in keys]
+
+  def get_hidden_reps(self, prompts, layers, positions):
+    """Returns the residual of each prompt at the given layer and position."""
+    return [
+        states[layer + 1][position].to(self.mt.device)
+        for states, layer, position in zip(
+            self.lookup(prompts), layers, positions
+        )
+    ]
+
+  def get_logits(self, prompts, positions):
+    """Returns the next token logits of each prompt at the given position."""
+    # The last hidden state already has the final layer norm applied.
+    final_hs = torch.stack([
+        states[-1][position]
+        for states, position in zip(self.lookup(prompts), positions)
+    ]).to(self.mt.device)
+    return self.mt.model.get_output_embeddings()(final_hs).float()
+
+
+class PrefixKVCache:
+  """An LRU cache of the past key/values of unpatched target prompt prefixes.
+
+  Positions before the earliest patched position of a target prompt do not
+  depend on the patch, so the key/values of such a prefix (e.g. the few-shot
+  examples of the identity prompt) are computed once and reused by every
+  patched generation that starts with it.
+  """
+
+  def __init__(self, mt, max_entries=16):
+    self.mt = mt
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __repr__(self):
+    return (
+        f"PrefixKVCache({len(self)} entries, "
+        f"hits: {self.hits}, misses: {self.misses})"
+    )
+
+  def get_past(self, prefix_ids, batch_size=1):
+    """Returns the past key/values of prefix_ids, repeated batch_size times.
+
+    Args:
+      prefix_ids: the token ids of the unpadded prefix.
+      batch_size: the batch size of the returned past key/values.
+
+    Returns:
+      A tuple with a (key, value) pair of tensors of shape (batch_size,
+      num_heads, prefix_len, head_dim) per layer.
+    """
+    key = tuple(int(t) for t in prefix_ids)
+    if key in self._entries:
+      self._entries.move_to_end(key)
+      self.hits += 1
+    else:
+      self.misses += 1
+      output = self.mt.model(
+          input_ids=torch.tensor([key], device=self.mt.device),
+          use_cache=True,
+      )
+      past = output.past_key_values
+      if hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+      self._entries[key] = tuple(tuple(kv) for kv in past)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    # The models concatenate new key/values to the past ones, so the cached
+    # tensors are only read, and can be expanded without copies.
+    return tuple(
+        tuple(t.expand(batch_size, *t.shape[1:]) for t in kv)
+        for kv in self._entries[key]
+    )
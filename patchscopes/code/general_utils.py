@@ -19,14 +19,193 @@ Adapted from:
 https://github.com/kmeng01/rome/blob/bef95a6afd2ca15d794bdd4e3ee0f24283f9b996/
 """
 
+import collections
+import hashlib
 import re
+import threading
+import time
+import weakref
 
+import numpy as np
 import torch
+import tqdm
 import transformers
+from profile_utils import profiling_enabled
+from profile_utils import wrap_hook
+
+
+# Attribute paths of the modules that patchscopes hooks into, per model type.
+# "mlp", "attn" and "attn_out" (the output projection of the attention, whose
+# input holds the concatenated outputs of the heads) are relative to a layer
+# module.
+MODEL_COMPONENTS = {
+    "gpt2": dict(
+        layers="transformer.h", final_norm="transformer.ln_f",
+        mlp="mlp", attn="attn",
+        attn_out="attn.c_proj",
+    ),
+    "gpt_neo": dict(
+        layers="transformer.h", final_norm="transformer.ln_f",
+        mlp="mlp", attn="attn",
+        attn_out="attn.attention.out_proj",
+    ),
+    "gptj": dict(
+        layers="transformer.h", final_norm="transformer.ln_f",
+        mlp="mlp", attn="attn",
+        attn_out="attn.out_proj",
+    ),
+    "gpt_neox": dict(
+        layers="gpt_neox.layers", final_norm="gpt_neox.final_layer_norm",
+        mlp="mlp", attn="attention",
+        attn_out="attention.dense",
+    ),
+    "llama": dict(
+        layers="model.layers", final_norm="model.norm",
+        mlp="mlp", attn="self_attn",
+        attn_out="self_attn.o_proj",
+    ),
+    "mistral": dict(
+        layers="model.layers", final_norm="model.norm",
+        mlp="mlp", attn="self_attn",
+        attn_out="self_attn.o_proj",
+    ),
+}
+
+_COMPONENTS_CACHE = weakref.WeakKeyDictionary()
+
+# Per tokenizer memos of the pad id, of the encodings of recent prompts and
+# of the decoded string of each token.
+_PAD_ID_CACHE = weakref.WeakKeyDictionary()
+_ENCODING_CACHE = weakref.WeakKeyDictionary()
+# The encodings are evicted once they hold more tokens than this, per
+# tokenizer.
+_ENCODING_CACHE_TOKENS = 2**22
+_ENCODING_CACHE_LOCK = threading.Lock()
+_TOKEN_TABLE_CACHE = weakref.WeakKeyDictionary()
+
+
+class ModelComponents:
+  """The modules of a causal language model that patchscopes hooks into."""
+
+  def __init__(self, model, paths):
+    self.paths = paths
+    self.layers = model.get_submodule(paths["layers"])
+    self.final_norm = model.get_submodule(paths["final_norm"])
+    self.embedding = model.get_input_embeddings()
+    self.unembedding = model.get_output_embeddings()
+    config = model.config
+    self.num_heads = getattr(
+        config, "num_attention_heads", getattr(config, "n_head", None)
+    )
+    self.layer_names = [
+        f"{paths['layers']}.{i}" for i in range(len(self.layers))
+    ]
+
+  def get_module(self, module, layer):
+    """Returns the `module` ("hs", "mlp", "attn" or "attn_heads") of a layer.
+
+    For "attn_heads", this is the output projection of the attention, whose
+    input holds the concatenated outputs of the heads.
+    """
+    if module == "hs":
+      return self.layers[layer]
+    elif module in ("mlp", "attn"):
+      return self.layers[layer].get_submodule(self.paths[module])
+    elif module == "attn_heads":
+      return self.layers[layer].get_submodule(self.paths["attn_out"])
+    else:
+      raise ValueError("Module %s not supported" % module)
+
+
+def _infer_component_paths(model):
+  """Infers the component paths of a model type missing from the registry."""
+  names = dict(model.named_modules())
+  layers = [
+      n
+      for n in names
+      if re.match(r"^(transformer|gpt_neox|model)\.(h|layers)$", n)
+  ]
+  if not layers:
+    raise ValueError(
+        "Unsupported model type %s" % getattr(model.config, "model_type", None)
+    )
+  parent = layers[0].rsplit(".", 1)[0]
+  final_norm = [
+      f"{parent}.{n}"
+      for n in ("ln_f", "norm", "final_layer_norm")
+      if f"{parent}.{n}" in names
+  ]
+  children = dict(names[layers[0] + ".0"].named_children())
+  attn = [
+      n
+      for n in ("self_attn", "attn", "attention", "self_attention")
+      if n in children
+  ][0]
+  attn_children = dict(children[attn].named_modules())
+  return dict(
+      layers=layers[0],
+      final_norm=final_norm[0],
+      mlp=[n for n in ("mlp", "feed_forward") if n in children][0],
+      attn=attn,
+      attn_out=[
+          f"{attn}.{n}"
+          for n in (
+              "o_proj", "out_proj", "dense", "c_proj", "attention.out_proj"
+          )
+          if n in attn_children
+      ][0],
+  )
+
+
+def quantize_model(model, quantize="int8"):
+  """Dynamically quantizes the Linear layers of model, for CPU inference."""
+  if quantize != "int8":
+    raise ValueError("Unsupported quantization %s" % quantize)
+  if any(p.device.type != "cpu" for p in model.parameters()):
+    raise ValueError(
+        "Dynamic quantization requires a model on the CPU, e.g. device=\"cpu\""
+    )
+  return torch.quantization.quantize_dynamic(
+      model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+  )
+
+
+def resolve_model_components(model):
+  """Resolves (and memoizes) the patchscopes components of `model`."""
+  if model not in _COMPONENTS_CACHE:
+    model_type = getattr(model.config, "model_type", None)
+    if model_type in MODEL_COMPONENTS:
+      paths = MODEL_COMPONENTS[model_type]
+    else:
+      paths = _infer_component_paths(model)
+    _COMPONENTS_CACHE[model] = ModelComponents(model, paths)
+  return _COMPONENTS_CACHE[model]
+
+
+class _StopForward(Exception):
+  """Raised by a hook to stop a forward pass after the last needed layer."""
 
 
 class ModelAndTokenizer:
-  """An object to hold a GPT-style language model and tokenizer."""
+  """An object to hold a GPT-style language model and tokenizer.
+
+  With a `device_map` (e.g. "auto", requires `accelerate`), the model is
+  loaded shard by shard from memory-mapped safetensors weights, and layers
+  that do not fit in `max_memory` are offloaded to the CPU or to
+  `offload_folder` and streamed to their execution device on each forward
+  pass. As the source passes stop after the deepest needed layer, offloaded
+  layers after it are never loaded. `load_stats` reports the load time and
+  the peak resident memory of the process after loading (None where the
+  `resource` module is unavailable, e.g. on Windows).
+
+  With `quantize="int8"`, the Linear layers of the model are dynamically
+  quantized to int8 for CPU inference, which requires `device="cpu"`. Their
+  activations, and so the residuals that patchscopes read and patch, stay in
+  full precision.
+
+  With `pin_memory=True`, the batch evaluators build their inputs in pinned
+  host memory and copy them to `device` without blocking (see `make_inputs`).
+  """
 
   def __init__(
       self,
@@ -37,30 +216,206 @@ class ModelAndTokenizer:
       torch_dtype=None,
       use_fast=True,
       device="cuda",
+      device_map=None,
+      max_memory=None,
+      offload_folder=None,
+      quantize=None,
+      pin_memory=False,
       ):
+    start_time = time.perf_counter()
     if tokenizer is None:
       assert model_name is not None
       tokenizer = transformers.AutoTokenizer.from_pretrained(model_name, use_fast=use_fast)
     if model is None:
       assert model_name is not None
-      model = transformers.AutoModelForCausalLM.from_pretrained(
-          model_name, low_cpu_mem_usage=low_cpu_mem_usage,
-          torch_dtype=torch_dtype
-          )
-      if device is not None:
-        model.to(device)
+      if device_map is not None:
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            model_name, low_cpu_mem_usage=True, torch_dtype=torch_dtype,
+            device_map=device_map, max_memory=max_memory,
+            offload_folder=offload_folder, offload_state_dict=True,
+            )
+      else:
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            model_name, low_cpu_mem_usage=low_cpu_mem_usage,
+            torch_dtype=torch_dtype
+            )
+        if device is not None:
+          model.to(device)
       set_requires_grad(False, model)
       model.eval()
+    if quantize is not None:
+      model = quantize_model(model, quantize)
+    if device_map is not None:
+      # Inputs go to the device of the embeddings, or the CPU if offloaded.
+      device = model.get_input_embeddings().weight.device
+      if device.type == "meta":
+        device = torch.device("cpu")
     self.tokenizer = tokenizer
     self.model = model
     self.device = device
-    self.layer_names = [
-        n
-        for n, _ in model.named_modules()
-        if (re.match(r"^(transformer|gpt_neox|model)\.(h|layers)\.\d+$", n))
-    ]
+    self.pin_memory = pin_memory
+    self.load_stats = dict(
+        load_time_s=time.perf_counter() - start_time,
+        peak_rss_mb=_peak_rss_mb(),
+    )
+    self.components = resolve_model_components(model)
+    self.layer_names = self.components.layer_names
     self.num_layers = len(self.layer_names)
 
+  def forward_to_layer(self, max_layer, **inputs):
+    """Runs the model only up to (and including) layer max_layer.
+
+    The layers after max_layer and the LM head are skipped, unless max_layer
+    is the last layer, whose residual is read after the final layer norm as
+    with `output_hidden_states=True`.
+
+    Args:
+      max_layer: the last layer whose residual is needed.
+      **inputs: the inputs of the model, e.g. from `make_inputs`.
+
+    Returns:
+      A tuple of (batch, seq_len, hidden_dim) tensors, indexed like the
+      `hidden_states` of the model: the input of the first layer, followed by
+      the residuals of layers 0 to max_layer.
+    """
+    if max_layer >= self.num_layers - 1:
+      return self.model(**inputs, output_hidden_states=True).hidden_states
+
+    hidden_states = []
+
+    # The input of the first layer is read from the output of the embedding,
+    # as some models (e.g. GPT-J) pass it to their layers as a keyword.
+    def store_embedding_hook(module, inp, output):
+      hidden_states.append(output)
+
+    def store_output_hook(module, inp, output):
+      hidden_states.append(
+          output if isinstance(output, torch.Tensor) else output[0]
+      )
+      if len(hidden_states) == max_layer + 2:
+        raise _StopForward()
+
+    hooks = [self.components.embedding.register_forward_hook(
+        wrap_hook("record/input", store_embedding_hook)
+    )]
+    for layer in range(max_layer + 1):
+      hooks.append(
+          self.components.layers[layer].register_forward_hook(
+              wrap_hook("record/hs/%d" % layer, store_output_hook)
+          )
+      )
+    try:
+      self.model(**inputs, use_cache=False)
+    except _StopForward:
+      pass
+    finally:
+      for hook in hooks:
+        hook.remove()
+    return tuple(hidden_states)
+
+  def capture_hidden_reps(
+      self, layers, positions, stop_early=True, batch_idx=None, module="hs",
+      **inputs
+  ):
+    """Runs the model and records only the residual needed by each row.
+
+    Instead of materializing the residuals of all the layers (as with
+    `output_hidden_states=True`), a hook on each requested layer copies the
+    residual of its rows at their position into a (batch, hidden_dim) buffer.
+    Residuals of the last layer are read after the final layer norm, as in
+    `hidden_states`. With `module` "mlp" or "attn", the outputs of the MLP or
+    attention of the layers are recorded instead, and with "attn_heads", the
+    concatenated outputs of the attention heads (the input of the output
+    projection), which reshape to (num_heads, head_dim).
+
+    Args:
+      layers: the layer of each row of the batch.
+      positions: the position of each row of the batch.
+      stop_early: whether to stop the forward pass once all the requested
+        outputs are recorded, skipping the following layers and the LM head.
+      batch_idx: the example of the batch that each (layer, position) is read
+        from, if not the i-th one for the i-th layer and position, e.g. to
+        read several residuals per example.
+      module: the output to record, one of "hs", "mlp", "attn" or
+        "attn_heads", or a sequence with the output to record for each row.
+      **inputs: the inputs of the model, e.g. from `make_inputs`.
+
+    Returns:
+      A tuple (hidden_reps, output) with the (len(layers), hidden_dim)
+      residuals and the output of the model, or None if the forward pass was
+      stopped early.
+    """
+    layers = np.asarray(layers, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    modules = np.broadcast_to(np.asarray(module, dtype=object), layers.shape)
+    if batch_idx is None:
+      batch_idx = np.arange(len(layers))
+    batch_idx = np.asarray(batch_idx, dtype=np.int64)
+    buffer = []
+    # The forward pass is stopped once every hook has recorded its rows.
+    num_pending = [0]
+
+    def capture_hook(rows):
+      rows_t = torch.from_numpy(rows)
+      batch_idx_t = torch.from_numpy(batch_idx[rows])
+      positions_t = torch.from_numpy(positions[rows])
+
+      def hook(module, inp, output=None):
+        if output is None:
+          # pre-hook on the output projection of the attention
+          output = inp
+        hs = output if isinstance(output, torch.Tensor) else output[0]
+        if not buffer:
+          buffer.append(hs.new_empty((len(layers), hs.shape[-1])))
+        # With a device_map, the layers may run on other devices than the
+        # buffer, which is on the device of the first recorded layer.
+        buffer[0][rows_t.to(buffer[0].device)] = hs[
+            batch_idx_t.to(hs.device), positions_t.to(hs.device)
+        ].to(buffer[0].device)
+        num_pending[0] -= 1
+        if stop_early and num_pending[0] == 0:
+          raise _StopForward()
+
+      return hook
+
+    hooks = []
+    for module_, layer in sorted(set(zip(modules, layers))):
+      rows = np.nonzero((modules == module_) & (layers == layer))[0]
+      hook = capture_hook(rows)
+      if profiling_enabled():
+        hook = wrap_hook(
+            "capture/%s/%d" % (module_, layer),
+            hook,
+            bytes_written=len(rows) * self.model.config.hidden_size
+            * self.model.get_input_embeddings().weight.element_size(),
+        )
+      if module_ == "hs" and layer == self.num_layers - 1:
+        hooks.append(self.components.final_norm.register_forward_hook(hook))
+      elif module_ == "attn_heads":
+        hooks.append(
+            self.components.get_module(module_, layer)
+            .register_forward_pre_hook(hook)
+        )
+      else:
+        hooks.append(
+            self.components.get_module(module_, layer).register_forward_hook(
+                hook
+            )
+        )
+    num_pending[0] = len(hooks)
+    output = None
+    try:
+      if not stop_early:
+        output = self.model(**inputs)
+      else:
+        self.model(**inputs, use_cache=False)
+    except _StopForward:
+      pass
+    finally:
+      for hook in hooks:
+        hook.remove()
+    return buffer[0], output
+
   def __repr__(self):
     """String representation of this class.
     """
@@ -71,48 +426,342 @@ class ModelAndTokenizer:
         )
 
 
-def make_inputs(tokenizer, prompts, device="cuda"):
-  """Prepare inputs to the model."""
-  token_lists = [tokenizer.encode(p) for p in prompts]
-  maxlen = max(len(t) for t in token_lists)
-  if "[PAD]" in tokenizer.all_special_tokens:
-    pad_id = tokenizer.all_special_ids[
-        tokenizer.all_special_tokens.index("[PAD]")
-        ]
-  else:
-    pad_id = 0
-  input_ids = [
-      [pad_id] * (maxlen - len(t)) + t for t in token_lists]
-  attention_mask = [
-      [0] * (maxlen - len(t)) + [1] * len(t) for t in token_lists
-      ]
+def _peak_rss_mb():
+  """The peak resident memory of the process, or None if unavailable."""
+  try:
+    import resource
+  except ImportError:  # e.g. on Windows
+    return None
+  # ru_maxrss is in kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def model_id(model):
+  """Identifies the weights of model, e.g. to key stored outputs of it.
+
+  The id holds the name or path, dtype and quantization of model, and a hash
+  of a sample of its input and output embeddings, which tells apart
+  checkpoints saved at the same path.
+  """
+  config = model.config
+  quantized = any("quantized" in type(m).__module__ for m in model.modules())
+  digest = hashlib.sha1()
+  embeddings = (model.get_input_embeddings(), model.get_output_embeddings())
+  for embedding in embeddings:
+    # Quantized Linear layers (e.g. the LM head) expose weight as a method.
+    weight = getattr(embedding, "weight", None)
+    if callable(weight):
+      weight = weight().dequantize()
+    if weight is None or weight.device.type == "meta":
+      continue
+    weight = weight.detach().flatten()
+    sample = weight[:: max(1, weight.numel() // 4096)]
+    digest.update(sample.float().cpu().numpy().tobytes())
+  return "%s:%s:%s:%s" % (
+      getattr(config, "_name_or_path", "") or type(model).__name__,
+      model.dtype,
+      "int8" if quantized else "float",
+      digest.hexdigest()[:16],
+  )
+
+
+def get_pad_id(tokenizer):
+  """The id that `make_inputs` pads with."""
+  if tokenizer not in _PAD_ID_CACHE:
+    if "[PAD]" in tokenizer.all_special_tokens:
+      _PAD_ID_CACHE[tokenizer] = tokenizer.all_special_ids[
+          tokenizer.all_special_tokens.index("[PAD]")
+          ]
+    else:
+      _PAD_ID_CACHE[tokenizer] = 0
+  return _PAD_ID_CACHE[tokenizer]
+
+
+def encode_prompts(tokenizer, prompts):
+  """Encodes prompts as `tokenizer.encode` does, memoizing recent prompts.
+
+  Prompts missing from the memo are encoded together, with the batch
+  encoding of fast tokenizers.
+  """
+  prompts = list(prompts)
+  with _ENCODING_CACHE_LOCK:
+    cache = _ENCODING_CACHE.setdefault(tokenizer, _EncodingCache())
+    token_lists = [cache.entries.get(p) for p in prompts]
+  missing = list({p: None for p, t in zip(prompts, token_lists) if t is None})
+  if missing:
+    if getattr(tokenizer, "is_fast", False):
+      encoded = tokenizer(missing)["input_ids"]
+    else:
+      encoded = [tokenizer.encode(p) for p in missing]
+    encoded = dict(zip(missing, encoded))
+    token_lists = [
+        encoded[p] if t is None else t for p, t in zip(prompts, token_lists)
+    ]
+    with _ENCODING_CACHE_LOCK:
+      cache.update(encoded)
+  return token_lists
+
+
+class _EncodingCache:
+  """The encodings of recent prompts, bounded by their number of tokens."""
+
+  def __init__(self):
+    self.entries = collections.OrderedDict()
+    self.num_tokens = 0
+
+  def update(self, encoded):
+    for prompt, tokens in encoded.items():
+      if prompt not in self.entries:
+        self.entries[prompt] = tokens
+        self.num_tokens += len(tokens)
+    while self.num_tokens > _ENCODING_CACHE_TOKENS:
+      _, tokens = self.entries.popitem(last=False)
+      self.num_tokens -= len(tokens)
+
+
+def make_inputs(tokenizer, prompts, device="cuda", pin_memory=False):
+  """Prepare inputs to the model.
+
+  If `pin_memory`, the inputs are built in pinned host memory and copied to
+  `device` without blocking.
+  """
+  token_lists = encode_prompts(tokenizer, prompts)
+  lengths = np.array([len(t) for t in token_lists])
+  tokens = np.fromiter(
+      (t for token_list in token_lists for t in token_list),
+      dtype=np.int64,
+      count=lengths.sum(),
+  )
+  return pad_inputs(tokens, lengths, get_pad_id(tokenizer), device, pin_memory)
+
+
+def pad_inputs(tokens, lengths, pad_id, device="cuda", pin_memory=False):
+  """Left pads the concatenated tokens of prompts into inputs to the model.
+
+  Args:
+    tokens: a 1d int64 array with the tokens of all the prompts, one prompt
+      after the other.
+    lengths: the number of tokens of each prompt.
+    pad_id: the padding token id, e.g. from `get_pad_id`.
+    device: the device of the inputs.
+    pin_memory: whether to build the inputs in pinned host memory and copy
+      them to `device` without blocking.
+
+  Returns:
+    A dict with the (len(lengths), max(lengths)) "input_ids" and
+    "attention_mask".
+  """
+  lengths = np.asarray(lengths, dtype=np.int64)
+  maxlen = lengths.max()
+  # Inputs are left padded: row i holds its tokens in its last lengths[i]
+  # columns.
+  rows = np.repeat(np.arange(len(lengths)), lengths)
+  offsets = maxlen - lengths - (np.cumsum(lengths) - lengths)
+  cols = np.arange(lengths.sum()) + np.repeat(offsets, lengths)
+  input_ids = torch.full((len(lengths), maxlen), pad_id, dtype=torch.long)
+  attention_mask = torch.zeros((len(lengths), maxlen), dtype=torch.long)
+  rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+  input_ids[rows, cols] = torch.from_numpy(
+      np.asarray(tokens, dtype=np.int64)
+  )
+  attention_mask[rows, cols] = 1
+  if pin_memory:
+    input_ids = input_ids.pin_memory()
+    attention_mask = attention_mask.pin_memory()
   return dict(
-      input_ids=torch.tensor(input_ids).to(device),
-      attention_mask=torch.tensor(attention_mask).to(device),
+      input_ids=input_ids.to(device, non_blocking=pin_memory),
+      attention_mask=attention_mask.to(device, non_blocking=pin_memory),
       )
 
 
+def plan_length_batches(
+    tokenizer,
+    df,
+    max_tokens,
+    max_rows=None,
+    columns=("prompt_source", "prompt_target"),
+    group_by=(),
+):
+  """Groups the rows of df into batches of similar prompt lengths.
+
+  Rows are sorted by the tokenized lengths of their prompts in `columns`, and
+  consecutive rows are grouped as long as the padded size of the batch (the
+  number of rows times the sum of the longest prompt of each column) stays
+  within `max_tokens`, so that a few long prompts do not inflate the padding
+  of every batch. A row that alone exceeds `max_tokens` gets its own batch.
+
+  Args:
+    tokenizer: the tokenizer used by `make_inputs`.
+    df: a DataFrame with the prompt columns.
+    max_tokens: the token budget of a padded batch.
+    max_rows: an optional maximum number of rows per batch.
+    columns: the prompt columns of df that are tokenized in each batch.
+    group_by: columns of df whose values must be the same within a batch
+      (e.g. "prefix", which the attribute extraction reads from the first
+      row of each batch).
+
+  Returns:
+    A list of arrays with the positions (as in `df.iloc`) of the rows of each
+    batch. Their concatenation is a permutation of range(len(df)).
+  """
+  lens = [
+      [len(t) for t in encode_prompts(tokenizer, df[column])]
+      for column in columns
+  ]
+  lens = np.array(lens, dtype=np.int64).reshape(len(columns), len(df)).T
+  if group_by:
+    groups = df.groupby(list(group_by), sort=False).indices.values()
+  else:
+    groups = [np.arange(len(df))]
+
+  batches = []
+  for group in groups:
+    # Sort by the longest prompt of each row, then by each column's length.
+    group_lens = lens[group]
+    order = group[
+        np.lexsort(tuple(group_lens.T[::-1]) + (group_lens.max(axis=1),))
+    ]
+    batch = []
+    batch_maxlen = np.zeros(len(columns), dtype=np.int64)
+    for row in order:
+      maxlen = np.maximum(batch_maxlen, lens[row])
+      if batch and (
+          (len(batch) + 1) * maxlen.sum() > max_tokens
+          or (max_rows is not None and len(batch) >= max_rows)
+      ):
+        batches.append(np.array(batch))
+        batch = []
+        maxlen = lens[row]
+      batch.append(row)
+      batch_maxlen = maxlen
+    if batch:
+      batches.append(np.array(batch))
+  return batches
+
+
+def get_token_table(tokenizer):
+  """Returns an array with the decoded string of each token of the tokenizer.
+
+  Models may pad their vocab past the `len(tokenizer)` entries of the table,
+  see `decode_tokens`.
+  """
+  if tokenizer not in _TOKEN_TABLE_CACHE:
+    table = np.empty(len(tokenizer), dtype=object)
+    table[:] = [tokenizer.decode([t]) for t in range(len(tokenizer))]
+    _TOKEN_TABLE_CACHE[tokenizer] = table
+  return _TOKEN_TABLE_CACHE[tokenizer]
+
+
+def iter_batches(n_rows, batch_size, start=0, drop_last=False):
+  """Yields the row positions of consecutive batches of range(start, n_rows).
+
+  Every row is covered exactly once, the last batch holding the remainder,
+  unless `drop_last` drops it when it is shorter than batch_size.
+  """
+  if drop_last:
+    n_rows -= n_rows % batch_size
+  for batch_start in range(start, n_rows, batch_size):
+    yield np.arange(batch_start, min(batch_start + batch_size, n_rows))
+
+
+class BatchProgress:
+  """Reports the progress and throughput of batch evaluations.
+
+  Wraps the per-batch results of an evaluation in a progress bar that shows
+  rows/s and, when the evaluation reports the number of prompt tokens of its
+  batches (the sums of their attention masks), prompt tokens/s. The duration
+  of each batch is kept in `batch_times`.
+  """
+
+  def __init__(self, desc=None):
+    self.desc = desc
+    self.batch_times = []
+    self.num_rows = 0
+    self.num_tokens = 0
+    self.elapsed = 0.0
+
+  def track(self, batches, results):
+    """Yields the results of each batch, recording its duration and size.
+
+    Args:
+      batches: the rows (e.g. an array of positions, or a DataFrame) of each
+        batch.
+      results: the (batch_results, num_tokens) of each batch, where
+        num_tokens is the number of prompt tokens of the batch, or None.
+
+    Yields:
+      The batch_results of each batch.
+    """
+    with tqdm.tqdm(total=len(batches), desc=self.desc) as progress:
+      start_time = time.perf_counter()
+      for batch, (batch_results, num_tokens) in zip(batches, results):
+        end_time = time.perf_counter()
+        self.batch_times.append(end_time - start_time)
+        self.elapsed += end_time - start_time
+        self.num_rows += len(batch)
+        postfix = {"rows/s": f"{self.num_rows / self.elapsed:.1f}"}
+        if num_tokens is not None:
+          self.num_tokens += num_tokens
+          postfix["tokens/s"] = f"{self.num_tokens / self.elapsed:.1f}"
+        progress.set_postfix(postfix, refresh=False)
+        progress.update(1)
+        yield batch_results
+        start_time = time.perf_counter()
+
+
 def decode_tokens(tokenizer, token_array):
+  """Decodes each token of token_array on its own, by a vocab table lookup."""
   if hasattr(token_array, "shape") and len(token_array.shape) > 1:
     return [decode_tokens(tokenizer, row) for row in token_array]
-  return [tokenizer.decode([t]) for t in token_array]
+  if isinstance(token_array, torch.Tensor):
+    token_ids = token_array.cpu().numpy()
+  else:
+    token_ids = np.array([int(t) for t in token_array], dtype=np.int64)
+  table = get_token_table(tokenizer)
+  if (token_ids < len(table)).all():
+    return table[token_ids].tolist()
+  # The vocab of the model may be padded past the tokenizer (e.g. GPT-J), and
+  # the ids that the table does not hold are decoded one by one.
+  return [
+      table[t] if t < len(table) else tokenizer.decode([t]) for t in token_ids
+  ]
 
 
-def find_token_range(tokenizer, token_array, substring):
-  """Find the tokens corresponding to the given substring in token_array."""
+def find_token_ranges(tokenizer, token_array, substrings):
+  """Find the tokens corresponding to each substring in token_array.
+
+  The tokens are decoded once, and each substring is located through the
+  prefix sums of the lengths of the decoded tokens.
+
+  Args:
+    tokenizer: the tokenizer of token_array.
+    token_array: the token ids of a prompt.
+    substrings: the substrings to locate in the decoded prompt.
+
+  Returns:
+    A list with the (tok_start, tok_end) range of each substring.
+  """
   toks = decode_tokens(tokenizer, token_array)
   whole_string = "".join(toks)
-  char_loc = whole_string.index(substring)
-  loc = 0
-  tok_start, tok_end = None, None
-  for i, t in enumerate(toks):
-    loc += len(t)
-    if tok_start is None and loc > char_loc:
-      tok_start = i
-    if tok_end is None and loc >= char_loc + len(substring):
-      tok_end = i + 1
-      break
-  return (tok_start, tok_end)
+  # ends[i] is the end of token i in whole_string.
+  ends = np.cumsum([len(t) for t in toks])
+  ranges = []
+  for substring in substrings:
+    char_loc = whole_string.index(substring)
+    tok_start = int(np.searchsorted(ends, char_loc, side="right"))
+    tok_end = int(
+        np.searchsorted(ends, char_loc + len(substring), side="left")
+    )
+    ranges.append((
+        tok_start if tok_start < len(toks) else None,
+        tok_end + 1 if tok_end < len(toks) else None,
+    ))
+  return ranges
+
+
+def find_token_range(tokenizer, token_array, substring):
+  """Find the tokens corresponding to the given substring in token_array."""
+  return find_token_ranges(tokenizer, token_array, [substring])[0]
 
 
 def predict_from_input(model, inp):
@@ -13,11 +13,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+
 import numpy as np
 import torch
-import tqdm
+from general_utils import BatchProgress
 from general_utils import decode_tokens
+from general_utils import encode_prompts
+from general_utils import get_pad_id
+from general_utils import iter_batches
 from general_utils import make_inputs
+from general_utils import plan_length_batches
+from general_utils import resolve_model_components
+from pipeline_utils import SerialExecutor
+from plan_utils import resolve_patch_arrays
+from profile_utils import profile_span
+from profile_utils import wrap_hook
+from profile_utils import wrap_stage
+from results_utils import ArrayResultsSink
 
 
 # ##############
@@ -27,109 +40,195 @@ from general_utils import make_inputs
 # ##############
 
 
-def set_hs_patch_hooks_neox(
-    model,
-    hs_patch_config,
-    module="hs",  # mlp, attn
-    patch_input=False,
-    skip_final_ln=False,
-    generation_mode=False,
-):
-  """Neox patch hooks."""
-  # when using mode.generate() the hidden states in the input are cached after
-  # the first inference pass, and in the next steps the input/output are of
-  # size 1. In these cases we don't need to patch anymore the previous hidden
-  # states from the initial input, because they are cached, but we do need to
-  # handle these cases in this call because this hook wraps the generation call.
-  #
-  # NOTE: To use generation mode, we must patch a position that is not the
-  # first one. This is because in this case we don't know during generation if
-  # we are handling the initial input or a future step and thus don't know if
-  # a patching is needed or not.
-
-  # if generation_mode:
-  #     for i in hs_patch_config:
-  #         for position_, _ in hs_patch_config[i]:
-  #             assert position_ > 0
+# when using mode.generate() the hidden states in the input are cached after
+# the first inference pass, and in the next steps the input/output are of
+# size 1. In these cases we don't need to patch anymore the previous hidden
+# states from the initial input, because they are cached, but we do need to
+# handle these cases in this call because this hook wraps the generation call.
+#
+# NOTE: To use generation mode, we must patch a position that is not the
+# first one. This is because in this case we don't know during generation if
+# we are handling the initial input or a future step and thus don't know if
+# a patching is needed or not.
 
-  if module != "hs":
-    raise ValueError("Module %s not yet supported", module)
 
-  def patch_hs(name, position_hs, patch_input, generation_mode):
-    def pre_hook(module, input):
-      # (batch, sequence, hidden_state)
-      input_len = len(input[0][0])
-      if generation_mode and input_len == 1:
-        return
-      for position_, hs_ in position_hs:
-        input[0][0, position_] = hs_
-
-    def post_hook(module, input, output):
-      if "skip_ln" in name:
-        # output: (batch, sequence, hidden_state)
-        output_len = len(output[0])
-      else:
-        # output[0]: (batch, sequence, hidden_state)
-        output_len = len(output[0][0])
-
-      if generation_mode and output_len == 1:
-        return
-      for position_, hs_ in position_hs:
-        if "skip_ln" in name:
-          output[0][position_] = hs_
-        else:
-          output[0][0, position_] = hs_
+# The modules that the batch evaluators capture from the source prompts and
+# patch into the target prompts.
+BATCH_MODULES = ("hs", "mlp", "attn", "attn_heads")
 
-    if patch_input:
-      return pre_hook
+
+def _patch_config_columns(hs_patch_config):
+  """Converts a list of patch items to a columnar patch config."""
+  if isinstance(hs_patch_config, dict):
+    return hs_patch_config
+  columns = {
+      key: np.array([int(item[key]) for item in hs_patch_config])
+      for key in ("batch_idx", "layer_target", "position_target")
+  }
+  columns["skip_final_ln"] = np.array(
+      [bool(item["skip_final_ln"]) for item in hs_patch_config], dtype=bool
+  )
+  columns["head"] = np.array(
+      [
+          -1 if item.get("head") is None else int(item["head"])
+          for item in hs_patch_config
+      ],
+      dtype=np.int64,
+  )
+  # Head slices and full representations differ in size, so they stay a list.
+  columns["hidden_rep"] = [item["hidden_rep"] for item in hs_patch_config]
+  return columns
+
+
+def _group_batch_patch_config(hs_patch_config, skip_ln_layer):
+  """Groups a batch patch config by the module that each item patches.
+
+  Args:
+    hs_patch_config: a list of dicts with keys "batch_idx", "layer_target",
+      "position_target", "hidden_rep" and "skip_final_ln", and optionally
+      "head", to patch only the slice of that attention head (when patching
+      "attn_heads") with a hidden_rep of size head_dim. Or a columnar config:
+      a dict mapping the same keys to arrays with one entry per item, with
+      the hidden_rep tensors stacked (and a "head" of -1 for full items).
+    skip_ln_layer: the layer whose items patch the output of the final layer
+      norm when their "skip_final_ln" is set, or None.
+
+  Returns:
+    A dict mapping (layer_target, skip_ln, by_head) to an (indices,
+    hidden_rep) tuple holding all the items of that group, where indices are
+    the (batch_idx, position_target) tensors and hidden_rep is stacked to
+    (n_items, hidden_dim), or, for items with a "head", indices also hold the
+    hidden dimension of each element and hidden_rep is flattened.
+  """
+  columns = _patch_config_columns(hs_patch_config)
+  layer = np.asarray(columns["layer_target"], dtype=np.int64)
+  batch_idx = np.asarray(columns["batch_idx"], dtype=np.int64)
+  position = np.asarray(columns["position_target"], dtype=np.int64)
+  head = np.asarray(columns.get("head", np.full(len(layer), -1)))
+  skip_ln = np.asarray(columns["skip_final_ln"], dtype=bool) & (
+      layer == (-1 if skip_ln_layer is None else skip_ln_layer)
+  )
+  group_keys = np.stack([layer, skip_ln, head >= 0], axis=1)
+
+  grouped = {}
+  for i, group_skip_ln, by_head in np.unique(group_keys, axis=0):
+    rows = np.nonzero((group_keys == (i, group_skip_ln, by_head)).all(1))[0]
+    # Later items win when the same (batch_idx, position) is patched twice,
+    # as when one hook was registered per item.
+    item_keys = np.stack([batch_idx[rows], position[rows], head[rows]], 1)
+    _, last = np.unique(item_keys[::-1], axis=0, return_index=True)
+    rows = np.sort(rows[::-1][last])
+    if isinstance(columns["hidden_rep"], torch.Tensor):
+      hidden_rep = columns["hidden_rep"][
+          torch.from_numpy(rows).to(columns["hidden_rep"].device)
+      ]
     else:
-      return post_hook
+      hidden_rep = torch.stack([columns["hidden_rep"][r] for r in rows])
+    indices = [
+        torch.from_numpy(idx[rows]).to(hidden_rep.device)
+        for idx in (batch_idx, position)
+    ]
+    if by_head:
+      # Each head patches head_dim consecutive elements of the hidden state.
+      head_dim = hidden_rep.shape[-1]
+      heads = torch.from_numpy(head[rows]).to(hidden_rep.device)
+      dims = heads[:, None] * head_dim + torch.arange(
+          head_dim, device=hidden_rep.device
+      )
+      indices = [idx[:, None].expand_as(dims).flatten() for idx in indices]
+      indices.append(dims.flatten())
+      hidden_rep = hidden_rep.flatten()
+    grouped[(int(i), bool(group_skip_ln), bool(by_head))] = (
+        tuple(indices),
+        hidden_rep,
+    )
+  return grouped
+
+
+def _batch_patch_hook(indices, hidden_rep, patch_input, generation_mode):
+  """Returns a hook that patches all the items of a group at once."""
+
+  def patch(hs):
+    # hs: (batch, sequence, hidden_state)
+    if generation_mode and hs.shape[1] == 1:
+      return
+    hs.index_put_(
+        tuple(idx.to(hs.device) for idx in indices),
+        hidden_rep.to(hs.device, hs.dtype),
+    )
+
+  def pre_hook(module, inp):
+    patch(inp[0])
+
+  def post_hook(module, inp, output):
+    # Layer norms and MLPs return the hidden states, layers and attention
+    # modules return a tuple.
+    patch(output if isinstance(output, torch.Tensor) else output[0])
+
+  if patch_input:
+    return pre_hook
+  else:
+    return post_hook
 
+
+def set_hs_patch_hooks_batch(
+    model,
+    hs_patch_config,
+    module="hs",  # mlp, attn, attn_heads
+    patch_input=False,
+    generation_mode=False,
+):
+  """Patch hooks supporting batch, for any supported architecture.
+
+  Items are grouped by target layer, so that a single hook patches all the
+  rows of the batch for that layer with one `index_put_`.
+
+  Args:
+    model: a causal language model supported by `resolve_model_components`.
+    hs_patch_config: a list of dicts with keys "batch_idx", "layer_target",
+      "position_target", "hidden_rep" and "skip_final_ln", and optionally
+      "head" when patching "attn_heads", or the equivalent columnar config
+      (see `_group_batch_patch_config`).
+    module: the output (or input, if `patch_input`) to patch, one of "hs",
+      "mlp" or "attn", or "attn_heads" for the concatenated outputs of the
+      attention heads (always the input of the attention output projection).
+    patch_input: whether to patch the input rather than the output of module.
+    generation_mode: whether to skip patching on single-token decoding steps.
+
+  Returns:
+    The list of registered hooks.
+  """
+  components = resolve_model_components(model)
+  grouped = _group_batch_patch_config(
+      hs_patch_config,
+      len(components.layers) - 1 if module == "hs" else None,
+  )
+  if module == "attn_heads":
+    patch_input = True
   hooks = []
-  for i in hs_patch_config:
+  for (i, skip_ln, _), (indices, hidden_rep) in grouped.items():
+    hook = wrap_hook(
+        "patch/%s/%d" % ("final_norm" if skip_ln else module, i),
+        _batch_patch_hook(indices, hidden_rep, patch_input, generation_mode),
+        bytes_written=hidden_rep.numel() * hidden_rep.element_size(),
+    )
     if patch_input:
       hooks.append(
-          model.gpt_neox.layers[i].register_forward_pre_hook(
-              patch_hs(
-                  f"patch_hs_{i}",
-                  hs_patch_config[i],
-                  patch_input,
-                  generation_mode,
-              )
-          )
+          components.get_module(module, i).register_forward_pre_hook(hook)
       )
+    # when patching a last-layer representation to the last layer of the same
+    # model, the final layer norm is not needed because it was already
+    # applied (assuming that the representation for patching was obtained by
+    # setting output_hidden_representations to True).
+    elif skip_ln:
+      hooks.append(components.final_norm.register_forward_hook(hook))
     else:
-      # when patching a last-layer representation to the last layer of the
-      # same model, the final layer norm is not needed because it was already
-      # applied (assuming that the representation for patching was obtained by
-      # setting output_hidden_representations to True).
-      if skip_final_ln and i == len(model.gpt_neox.layers) - 1:
-        hooks.append(
-            model.gpt_neox.final_layer_norm.register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}_skip_ln",
-                    hs_patch_config[i],
-                    patch_input,
-                    generation_mode,
-                )
-            )
-        )
-      else:
-        hooks.append(
-            model.gpt_neox.layers[i].register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}",
-                    hs_patch_config[i],
-                    patch_input,
-                    generation_mode,
-                )
-            )
-        )
+      hooks.append(components.get_module(module, i).register_forward_hook(hook))
 
   return hooks
 
 
-def set_hs_patch_hooks_llama(
+def set_hs_patch_hooks(
     model,
     hs_patch_config,
     module="hs",  # mlp, attn
@@ -137,109 +236,68 @@ def set_hs_patch_hooks_llama(
     skip_final_ln=False,
     generation_mode=False,
 ):
-  """Llama patch hooks."""
-  # when using mode.generate() the hidden states in the input are cached after
-  # the first inference pass, and in the next steps the input/output are of
-  # size 1. In these cases we don't need to patch anymore the previous hidden
-  # states from the initial input, because they are cached, but we do need to
-  # handle these cases in this call because this hook wraps the generation call.
-  #
-  # NOTE: To use generation mode, we must patch a position that is not the
-  # first one. This is because in this case we don't know during generation if
-  # we are handling the initial input or a future step and thus don't know if
-  # a patching is needed or not.
-
-  # if generation_mode:
-  #     for i in hs_patch_config:
-  #         for position_, _ in hs_patch_config[i]:
-  #             assert position_ > 0
-
-  def patch_hs(name, position_hs, patch_input, generation_mode):
-    def pre_hook(module, input):
-      # (batch, sequence, hidden_state)
-      input_len = len(input[0][0])
-      if generation_mode and input_len == 1:
-        return
-      for position_, hs_ in position_hs:
-        input[0][0, position_] = hs_
-
-    def post_hook(module, input, output):
-      if "skip_ln" in name or "mlp" in name:
-        # output: (batch, sequence, hidden_state)
-        output_len = len(output[0])
-      else:
-        # output[0]: (batch, sequence, hidden_state)
-        output_len = len(output[0][0])
-
-      if generation_mode and output_len == 1:
-        return
-      for position_, hs_ in position_hs:
-        if "skip_ln" in name or "mlp" in name:
-          output[0][position_] = hs_
-        else:
-          output[0][0, position_] = hs_
+  """Patch hooks for any supported architecture.
+
+  Args:
+    model: a causal language model supported by `resolve_model_components`.
+    hs_patch_config: a dict mapping a layer to a list of (position,
+      hidden_rep) pairs to patch into the first example of the batch.
+    module: the output (or input, if `patch_input`) to patch, one of "hs",
+      "mlp" or "attn".
+    patch_input: whether to patch the input rather than the output of module.
+    skip_final_ln: whether a last layer patch skips the final layer norm.
+    generation_mode: whether to skip patching on single-token decoding steps.
+
+  Returns:
+    The list of registered hooks.
+  """
+  return set_hs_patch_hooks_batch(
+      model,
+      [
+          {
+              "batch_idx": 0,
+              "layer_target": i,
+              "position_target": position_,
+              "hidden_rep": hs_,
+              "skip_final_ln": skip_final_ln,
+          }
+          for i in hs_patch_config
+          for position_, hs_ in hs_patch_config[i]
+      ],
+      module=module,
+      patch_input=patch_input,
+      generation_mode=generation_mode,
+  )
 
-    if patch_input:
-      return pre_hook
-    else:
-      return post_hook
 
-  hooks = []
-  for i in hs_patch_config:
-    patch_hook = patch_hs(
-        f"patch_{module}_{i}",
-        position_hs=hs_patch_config[i],
-        patch_input=patch_input,
-        generation_mode=generation_mode,
-    )
-    if patch_input:
-      if module == "hs":
-        hooks.append(
-            model.model.layers[i].register_forward_pre_hook(patch_hook)
-        )
-      elif module == "mlp":
-        hooks.append(
-            model.model.layers[i].mlp.register_forward_pre_hook(patch_hook)
-        )
-      elif module == "attn":
-        hooks.append(
-            model.model.layers[i].self_attn.register_forward_pre_hook(
-                patch_hook
-            )
-        )
-      else:
-        raise ValueError("Module %s not supported", module)
-    else:
-      # when patching a last-layer representation to the last layer of the same
-      # model, the final layer norm is not needed because it was already applied
-      # (assuming that the representation for patching was obtained by
-      # setting output_hidden_representations to True).
-      if skip_final_ln and i == len(model.model.layers) - 1 and module == "hs":
-        hooks.append(
-            model.model.norm.register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}_skip_ln",
-                    hs_patch_config[i],
-                    patch_input,
-                    generation_mode,
-                )
-            )
-        )
-      else:
-        if module == "hs":
-          hooks.append(model.model.layers[i].register_forward_hook(patch_hook))
-        elif module == "mlp":
-          hooks.append(
-              model.model.layers[i].mlp.register_forward_hook(patch_hook)
-          )
-        elif module == "attn":
-          hooks.append(
-              model.model.layers[i].self_attn.register_forward_hook(patch_hook)
-          )
-        else:
-          raise ValueError("Module %s not supported", module)
+def set_hs_patch_hooks_neox(
+    model,
+    hs_patch_config,
+    module="hs",  # mlp, attn
+    patch_input=False,
+    skip_final_ln=False,
+    generation_mode=False,
+):
+  """Neox patch hooks."""
+  return set_hs_patch_hooks(
+      model, hs_patch_config, module, patch_input, skip_final_ln,
+      generation_mode,
+  )
 
-  return hooks
+
+def set_hs_patch_hooks_llama(
+    model,
+    hs_patch_config,
+    module="hs",  # mlp, attn
+    patch_input=False,
+    skip_final_ln=False,
+    generation_mode=False,
+):
+  """Llama patch hooks."""
+  return set_hs_patch_hooks(
+      model, hs_patch_config, module, patch_input, skip_final_ln,
+      generation_mode,
+  )
 
 
 def set_hs_patch_hooks_gptj(
@@ -251,103 +309,256 @@ def set_hs_patch_hooks_gptj(
     generation_mode=False,
 ):
   """GPTJ patch hooks."""
-  # when using mode.generate() the hidden states in the input are cached after
-  # the first inference pass, and in the next steps the input/output are of
-  # size 1. In these cases we don't need to patch anymore the previous hidden
-  # states from the initial input, because they are cached, but we do need
-  # to handle these cases in this call because this hook wraps the generation
-  # call.
-  #
-  # NOTE: To use generation mode, we must patch a position that is not the
-  # first one. This is because in this case we don't know during generation
-  # if we are handling the initial input or a future step and thus don't know
-  # if a patching is needed or not.
-
-  # if generation_mode:
-  #     for i in hs_patch_config:
-  #         for position_, _ in hs_patch_config[i]:
-  #             assert position_ > 0
+  return set_hs_patch_hooks(
+      model, hs_patch_config, module, patch_input, skip_final_ln,
+      generation_mode,
+  )
 
-  if module != "hs":
-    raise ValueError("Module %s not yet supported", module)
 
-  def patch_hs(name, position_hs, patch_input, generation_mode):
-    def pre_hook(module, input):
-      # (batch, sequence, hidden_state)
-      input_len = len(input[0][0])
-      if generation_mode and input_len == 1:
-        return
-      for position_, hs_ in position_hs:
-        input[0][0, position_] = hs_
-
-    def post_hook(module, input, output):
-      if "skip_ln" in name:
-        # output: (batch, sequence, hidden_state)
-        output_len = len(output[0])
-      else:
-        # output[0]: (batch, sequence, hidden_state)
-        output_len = len(output[0][0])
-
-      if generation_mode and output_len == 1:
-        return
-      for position_, hs_ in position_hs:
-        if "skip_ln" in name:
-          output[0][position_] = hs_
-        else:
-          output[0][0, position_] = hs_
+def remove_hooks(hooks):
+  for hook in hooks:
+    hook.remove()
 
-    if patch_input:
-      return pre_hook
-    else:
-      return post_hook
 
-  hooks = []
-  for i in hs_patch_config:
-    if patch_input:
-      hooks.append(
-          model.transformer.h[i].register_forward_pre_hook(
-              patch_hs(
-                  f"patch_hs_{i}",
-                  hs_patch_config[i],
-                  patch_input,
-                  generation_mode,
-              )
-          )
+def _unpadded_position_ids(attention_mask):
+  """Position ids that ignore the left padding of `make_inputs`."""
+  position_ids = attention_mask.long().cumsum(-1) - 1
+  position_ids.masked_fill_(attention_mask == 0, 1)
+  return position_ids
+
+
+def _padded_positions(positions, inputs):
+  """Positions in the unpadded prompts, made absolute in the inputs."""
+  # Left padding shifts positive positions by the padding of each row.
+  lengths = inputs["attention_mask"].sum(-1).cpu().numpy()
+  seq_len = inputs["attention_mask"].shape[1]
+  return np.where(
+      positions < 0, positions + seq_len, positions + seq_len - lengths
+  )
+
+
+def _greedy_decode(mt, output, attention_mask, position_ids, max_gen_len):
+  """Greedy cached decoding that follows a (patched) prefill forward pass.
+
+  Args:
+    mt: the ModelAndTokenizer.
+    output: the model output of the prefill step, with its past_key_values.
+    attention_mask: the attention mask of the prefill step, including any
+      cached tokens.
+    position_ids: the position ids of the prefill step.
+    max_gen_len: the number of tokens to generate, for each row.
+
+  Returns:
+    A (batch, <= max(max_gen_len)) tensor of the generated token ids. Rows stop
+    at their own max_gen_len or at EOS, after which they hold EOS tokens, and
+    decoding stops once every row has stopped.
+  """
+  batch_size = attention_mask.shape[0]
+  max_gen_len = torch.as_tensor(max_gen_len, device=mt.device).expand(
+      batch_size
+  )
+  eos_token_id = mt.model.generation_config.eos_token_id
+  eos_token_ids = torch.tensor(
+      eos_token_id if isinstance(eos_token_id, list) else [eos_token_id],
+      device=mt.device,
+  )
+  pad_token_id = eos_token_ids[0]
+  finished = max_gen_len <= 0
+  output_toks = []
+  position_ids = position_ids[:, -1:]
+  for step in range(int(max_gen_len.max())):
+    next_toks = output.logits[:, -1].argmax(dim=-1)
+    next_toks = torch.where(finished, pad_token_id, next_toks)
+    output_toks.append(next_toks)
+    finished |= torch.isin(next_toks, eos_token_ids)
+    finished |= max_gen_len <= step + 1
+    if finished.all():
+      break
+    attention_mask = torch.cat(
+        [attention_mask, attention_mask.new_ones((batch_size, 1))], dim=-1
+    )
+    position_ids = position_ids + 1
+    output = mt.model(
+        input_ids=next_toks[:, None],
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=output.past_key_values,
+        use_cache=True,
+    )
+  if not output_toks:
+    return torch.zeros((batch_size, 0), dtype=torch.long, device=mt.device)
+  return torch.stack(output_toks, dim=1)
+
+
+def generate_patched(mt, inputs, hs_patch_config, max_gen_len, module="hs"):
+  """Greedy patched generation that only runs the patch hooks on prefill.
+
+  Unlike registering the patch hooks with `generation_mode=True` around
+  `mt.model.generate`, the hooks are removed after the forward pass over the
+  prompts, so the decoding steps run without hooks, and each row stops at
+  its own max_gen_len or at EOS rather than all rows generating
+  max(max_gen_len) tokens.
+
+  Args:
+    mt: the ModelAndTokenizer.
+    inputs: the left padded inputs of `make_inputs`.
+    hs_patch_config: a batch patch config (see `set_hs_patch_hooks_batch`),
+      with positions in inputs.
+    max_gen_len: the number of tokens to generate, an int or one per row.
+    module: the patched module, one of `BATCH_MODULES`.
+
+  Returns:
+    A (batch, <= max(max_gen_len)) tensor of the generated token ids, see
+    `_greedy_decode`.
+  """
+  position_ids = _unpadded_position_ids(inputs["attention_mask"])
+  patch_hooks = set_hs_patch_hooks_batch(
+      mt.model,
+      hs_patch_config,
+      module=module,
+      patch_input=False,
+      generation_mode=False,
+  )
+  try:
+    with profile_span("prefill"):
+      output = mt.model(
+          input_ids=inputs["input_ids"],
+          attention_mask=inputs["attention_mask"],
+          position_ids=position_ids,
+          use_cache=True,
       )
-    else:
-      # when patching a last-layer representation to the last layer of the same
-      # model, the final layer norm is not needed because it was already applied
-      # (assuming that the representation for patching was obtained by
-      # setting output_hidden_representations to True).
-      if skip_final_ln and i == len(model.transformer.h) - 1:
-        hooks.append(
-            model.transformer.ln_f.register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}_skip_ln",
-                    hs_patch_config[i],
-                    patch_input,
-                    generation_mode,
-                )
-            )
-        )
-      else:
-        hooks.append(
-            model.transformer.h[i].register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}",
-                    hs_patch_config[i],
-                    patch_input,
-                    generation_mode,
-                )
-            )
-        )
+  finally:
+    remove_hooks(patch_hooks)
+  with profile_span("decode"):
+    return _greedy_decode(
+        mt, output, inputs["attention_mask"], position_ids, max_gen_len
+    )
 
-  return hooks
 
+def _generate_with_prefix_cache(
+    mt, prefix_cache, prompts, hs_patch_config, max_gen_len, module="hs"
+):
+  """Greedy patched generation that reuses the key/values of a shared prefix.
+
+  Equivalent to `generate_patched` on `make_inputs(mt.tokenizer, prompts)`,
+  but the tokens that all prompts share before the earliest patched position
+  are read from `prefix_cache` (a `cache_utils.PrefixKVCache`) rather than
+  recomputed.
+
+  Args:
+    mt: the ModelAndTokenizer.
+    prefix_cache: a `cache_utils.PrefixKVCache` for mt.
+    prompts: the target prompts.
+    hs_patch_config: a batch patch config (see `set_hs_patch_hooks_batch`),
+      with positions in the left padded inputs of `make_inputs`.
+    max_gen_len: the number of tokens to generate, an int or one per row.
+    module: the patched module, one of `BATCH_MODULES`.
+
+  Returns:
+    A (batch, <= max(max_gen_len)) tensor of the generated token ids, see
+    `_greedy_decode`.
+  """
+  token_lists = encode_prompts(mt.tokenizer, prompts)
+  lengths = np.array([len(t) for t in token_lists])
+  hs_patch_config = _patch_config_columns(hs_patch_config)
+  batch_idx = np.asarray(hs_patch_config["batch_idx"], dtype=np.int64)
+  # The patched positions in the unpadded prompts.
+  positions = np.asarray(hs_patch_config["position_target"]) - (
+      lengths.max() - lengths[batch_idx]
+  )
 
-def remove_hooks(hooks):
-  for hook in hooks:
-    hook.remove()
+  # The prefix ends before the earliest patched position, and leaves at least
+  # one token per prompt to compute the first next token.
+  prefix_len = int(np.min(positions, initial=lengths.min() - 1))
+  for i in range(prefix_len):
+    if any(t[i] != token_lists[0][i] for t in token_lists):
+      prefix_len = i
+      break
+  batch_size = len(prompts)
+  past = None
+  if prefix_len > 0:
+    past = prefix_cache.get_past(token_lists[0][:prefix_len], batch_size)
+
+  # The suffixes are left padded between the prefix and themselves, and their
+  # position ids ignore the padding, as in generate.
+  suffixes = [t[prefix_len:] for t in token_lists]
+  suffix_len = max(len(t) for t in suffixes)
+  pad_id = get_pad_id(mt.tokenizer)
+  input_ids = torch.tensor(
+      [[pad_id] * (suffix_len - len(t)) + t for t in suffixes],
+      device=mt.device,
+  )
+  attention_mask = torch.tensor(
+      [
+          [1] * prefix_len + [0] * (suffix_len - len(t)) + [1] * len(t)
+          for t in suffixes
+      ],
+      device=mt.device,
+  )
+  position_ids = _unpadded_position_ids(attention_mask)[:, prefix_len:]
+
+  patch_hooks = set_hs_patch_hooks_batch(
+      mt.model,
+      dict(
+          hs_patch_config,
+          position_target=suffix_len - lengths[batch_idx] + positions,
+      ),
+      module=module,
+      patch_input=False,
+      generation_mode=False,
+  )
+  try:
+    with profile_span("prefill"):
+      output = mt.model(
+          input_ids=input_ids,
+          attention_mask=attention_mask,
+          position_ids=position_ids,
+          past_key_values=past,
+          use_cache=True,
+      )
+  finally:
+    remove_hooks(patch_hooks)
+
+  # The following decoding steps only attend to the patched key/values.
+  with profile_span("decode"):
+    return _greedy_decode(
+        mt, output, attention_mask, position_ids, max_gen_len
+    )
+
+
+def batched_transform(fn):
+  """Marks fn as a transform of stacked (batch, hidden_dim) residuals."""
+
+  @functools.wraps(fn)
+  def wrapper(hidden_reps):
+    return fn(hidden_reps)
+
+  wrapper.batched = True
+  return wrapper
+
+
+def apply_transform(transform, hidden_rep):
+  """Applies transform to the residuals of a batch.
+
+  Transforms marked with `batched_transform` and `torch.nn.Module`s (e.g. a
+  `torch.nn.Linear` mapping) are called once on the stacked residuals, while
+  any other callable is treated as a per-vector transform and called on each
+  row, as the batch evaluators used to do.
+
+  Args:
+    transform: a batched or per-vector transform.
+    hidden_rep: a (batch, hidden_dim) tensor or a list of hidden_dim vectors.
+
+  Returns:
+    A (batch, hidden_dim) tensor of the transformed residuals.
+  """
+  if not isinstance(hidden_rep, torch.Tensor):
+    hidden_rep = torch.stack(list(hidden_rep))
+  if getattr(transform, "batched", False) or isinstance(
+      transform, torch.nn.Module
+  ):
+    return transform(hidden_rep)
+  return torch.stack([transform(h) for h in hidden_rep])
 
 
 # ##############
@@ -370,8 +581,14 @@ def inspect(
     max_gen_len=20,
     verbose=False,
     temperature=None,
+    prefix_cache=None,
 ):
-  """Inspection via patching."""
+  """Inspection via patching.
+
+  If `prefix_cache` (a `cache_utils.PrefixKVCache`) is given, greedy
+  generations with module="hs" reuse the key/values of the target prompt
+  tokens before position_target.
+  """
   # adjust position_target to be absolute rather than relative
   inp_target = make_inputs(mt.tokenizer, [prompt_target], mt.device)
   if position_target < 0:
@@ -393,20 +610,29 @@ def inspect(
     def store_mlp_hook(module, input, output):
       hs_cache_.append(output[0])
 
-    for layer in mt.model.model.layers:
-      store_hooks.append(layer.mlp.register_forward_hook(store_mlp_hook))
+    for layer in range(mt.num_layers):
+      store_hooks.append(
+          mt.components.get_module("mlp", layer).register_forward_hook(
+              wrap_hook("record/mlp/%d" % layer, store_mlp_hook)
+          )
+      )
   elif module == "attn":
 
     def store_attn_hook(module, input, output):
       hs_cache_.append(output[0].squeeze())
 
-    for layer in mt.model.model.layers:
-      store_hooks.append(layer.self_attn.register_forward_hook(store_attn_hook))
+    for layer in range(mt.num_layers):
+      store_hooks.append(
+          mt.components.get_module("attn", layer).register_forward_hook(
+              wrap_hook("record/attn/%d" % layer, store_attn_hook)
+          )
+      )
 
-  output = mt.model(**inp_source, output_hidden_states=True)
+  # Layers after layer_source are not needed.
+  hidden_states = mt.forward_to_layer(layer_source, **inp_source)
   if module == "hs":
     hs_cache_ = [
-        output["hidden_states"][layer + 1][0] for layer in range(mt.num_layers)
+        hidden_states[layer + 1][0] for layer in range(layer_source + 1)
     ]
 
   remove_hooks(store_hooks)
@@ -423,14 +649,23 @@ def inspect(
     skip_final_ln = True
   else:
     skip_final_ln = False
-  patch_hooks = mt.set_hs_patch_hooks(
-      mt.model,
-      hs_patch_config,
-      module=module,
-      patch_input=False,
-      skip_final_ln=skip_final_ln,
-      generation_mode=True,
+  use_prefix_cache = (
+      prefix_cache is not None
+      and generation_mode
+      and not temperature
+      and module == "hs"
   )
+  if use_prefix_cache:
+    patch_hooks = []
+  else:
+    patch_hooks = mt.set_hs_patch_hooks(
+        mt.model,
+        hs_patch_config,
+        module=module,
+        patch_input=False,
+        skip_final_ln=skip_final_ln,
+        generation_mode=True,
+    )
 
   # Single prediction / generation
   if verbose:
@@ -444,7 +679,21 @@ def inspect(
   if generation_mode:
     # Checking if should perform temperature sampling, to allow smoother
     # non-repeating long outputs.
-    if temperature:
+    if use_prefix_cache:
+      output_toks = _generate_with_prefix_cache(
+          mt,
+          prefix_cache,
+          [prompt_target],
+          [{
+              "batch_idx": 0,
+              "layer_target": layer_target,
+              "position_target": position_target,
+              "hidden_rep": hs_cache_[layer_source][position_source],
+              "skip_final_ln": skip_final_ln,
+          }],
+          max_gen_len,
+      )[0]
+    elif temperature:
       output_toks = mt.model.generate(
           inp_target["input_ids"],
           max_length=len(inp_target["input_ids"][0]) + max_gen_len,
@@ -542,6 +791,139 @@ def evaluate_patch_next_token_prediction(
   return prec_1, surprisal
 
 
+def _set_layers_patch_hooks(
+    mt, layer_source, layers_target, position_target, hidden_rep,
+    generation_mode,
+):
+  """Patches hidden_rep into row i of the batch at layer layers_target[i]."""
+  hs_patch_config = [
+      {
+          "batch_idx": i,
+          "layer_target": layer_target,
+          "position_target": position_target,
+          "hidden_rep": hidden_rep,
+          "skip_final_ln": (
+              layer_source == layer_target == mt.num_layers - 1
+          ),
+      }
+      for i, layer_target in enumerate(layers_target)
+  ]
+  return set_hs_patch_hooks_batch(
+      mt.model,
+      hs_patch_config,
+      module="hs",
+      patch_input=False,
+      generation_mode=generation_mode,
+  )
+
+
+def evaluate_patch_next_token_prediction_layers(
+    mt,
+    prompt_source,
+    prompt_target,
+    layer_source,
+    layers_target,
+    position_source,
+    position_target,
+    module="hs",
+    position_prediction=-1,
+    transform=None,
+):
+  """Evaluate next token prediction for many target layers at once.
+
+  Equivalent to calling `evaluate_patch_next_token_prediction` for each layer
+  in `layers_target`, but the source prompt is run once, and the target prompt
+  is repeated along the batch dimension and run once, with row i patched at
+  layer layers_target[i].
+
+  Returns:
+    A tuple of arrays (prec_1, surprisal), with one entry per target layer.
+  """
+  if module != "hs":
+    raise ValueError("Module %s not yet supported", module)
+
+  # adjust position_target to be absolute rather than relative
+  inp_target = make_inputs(mt.tokenizer, [prompt_target], mt.device)
+  if position_target < 0:
+    position_target = len(inp_target["input_ids"][0]) + position_target
+
+  # first run the the model on without patching and get the results.
+  inp_source = make_inputs(mt.tokenizer, [prompt_source], mt.device)
+  output_orig = mt.model(**inp_source, output_hidden_states=True)
+  dist_orig = torch.softmax(output_orig.logits[0, position_source, :], dim=0)
+  _, answer_t_orig = torch.max(dist_orig, dim=0)
+  hidden_rep = output_orig["hidden_states"][layer_source + 1][0][
+      position_source
+  ]
+  if transform is not None:
+    hidden_rep = transform(hidden_rep)
+
+  # now do a single run on the target prompt repeated for each target layer,
+  # while patching the hidden state into each row at its own layer.
+  n_layers = len(layers_target)
+  inp_target = {k: v.expand(n_layers, -1) for k, v in inp_target.items()}
+  patch_hooks = _set_layers_patch_hooks(
+      mt, layer_source, layers_target, position_target, hidden_rep,
+      generation_mode=True,
+  )
+  output = mt.model(**inp_target)
+  dist = torch.softmax(output.logits[:, position_prediction, :], dim=-1)
+  _, answer_t = torch.max(dist, dim=-1)
+
+  # remove patching hooks
+  remove_hooks(patch_hooks)
+
+  prec_1 = (answer_t == answer_t_orig).detach().cpu().numpy()
+  surprisal = -torch.log(dist_orig[answer_t]).detach().cpu().numpy()
+
+  return prec_1, surprisal
+
+
+def inspect_layers(
+    mt,
+    prompt_source,
+    prompt_target,
+    layer_source,
+    layers_target,
+    position_source,
+    position_target,
+    max_gen_len=20,
+):
+  """Inspection via patching into many target layers at once.
+
+  Equivalent to calling `inspect` with `generation_mode=True` for each layer
+  in `layers_target`, but the source prompt is run once, and the generations
+  for all the target layers are decoded together as one batch.
+
+  Returns:
+    A list with the generation for each target layer.
+  """
+  # adjust position_target to be absolute rather than relative
+  inp_target = make_inputs(mt.tokenizer, [prompt_target], mt.device)
+  seq_len = len(inp_target["input_ids"][0])
+  if position_target < 0:
+    position_target = seq_len + position_target
+
+  inp_source = make_inputs(mt.tokenizer, [prompt_source], mt.device)
+  hidden_states = mt.forward_to_layer(layer_source, **inp_source)
+  hidden_rep = hidden_states[layer_source + 1][0][position_source]
+
+  patch_hooks = _set_layers_patch_hooks(
+      mt, layer_source, layers_target, position_target, hidden_rep,
+      generation_mode=True,
+  )
+  output_toks = mt.model.generate(
+      inp_target["input_ids"].expand(len(layers_target), -1),
+      max_length=seq_len + max_gen_len,
+      pad_token_id=mt.model.generation_config.eos_token_id,
+  )[:, seq_len:]
+
+  # remove patching hooks
+  remove_hooks(patch_hooks)
+
+  return [mt.tokenizer.decode(toks) for toks in output_toks]
+
+
 def evaluate_patch_next_token_prediction_x_model(
     mt_1,
     mt_2,
@@ -600,7 +982,6 @@ def evaluate_patch_next_token_prediction_x_model(
 
 
 # Adding support for batched patching. More than 10x speedup
-# Currently only supporting GPT-J
 def set_hs_patch_hooks_gptj_batch(
     model,
     hs_patch_config,
@@ -609,96 +990,9 @@ def set_hs_patch_hooks_gptj_batch(
     generation_mode=False,
 ):
   """GPTJ patch hooks - supporting batch."""
-  # when using mode.generate() the hidden states in the input are cached after
-  # the first inference pass, and in the next steps the input/output are of
-  # size 1. In these cases we don't need to patch anymore the previous hidden
-  # states from the initial input, because they are cached, but we do need to
-  # handle these cases in this call because this hook wraps the generation call.
-  #
-  # NOTE: To use generation mode, we must patch a position that is not the
-  # first one. This is because in this case we don't know during generation if
-  # we are handling the initial input or a future step and thus don't know if
-  # a patching is needed or not.
-
-  # if generation_mode:
-  #     for i in hs_patch_config:
-  #         for position_, _ in hs_patch_config[i]:
-  #             assert position_ > 0
-
-  if module != "hs":
-    raise ValueError("Module %s not yet supported", module)
-
-  def patch_hs(name, position_hs, patch_input, generation_mode):
-    def pre_hook(module, inp):
-      # (batch, sequence, hidden_state)
-      idx_, position_, hs_ = (
-          position_hs["batch_idx"],
-          position_hs["position_target"],
-          position_hs["hidden_rep"],
-      )
-      input_len = len(inp[0][idx_])
-      if generation_mode and input_len == 1:
-        return
-      inp[0][idx_][position_] = hs_
-
-    def post_hook(module, inp, output):
-      idx_, position_, hs_ = (
-          position_hs["batch_idx"],
-          position_hs["position_target"],
-          position_hs["hidden_rep"],
-      )
-      if "skip_ln" in name:
-        # output: (batch, sequence, hidden_state)
-        output_len = len(output[idx_])
-        if generation_mode and output_len == 1:
-          return
-        output[idx_][position_] = hs_
-      else:
-        # output[0]: (batch, sequence, hidden_state)
-        output_len = len(output[0][idx_])
-        if generation_mode and output_len == 1:
-          return
-        output[0][idx_][position_] = hs_
-
-    if patch_input:
-      return pre_hook
-    else:
-      return post_hook
-
-  hooks = []
-  for item in hs_patch_config:
-    i = item["layer_target"]
-    skip_final_ln = item["skip_final_ln"]
-    if patch_input:
-      hooks.append(
-          model.transformer.h[i].register_forward_pre_hook(
-              patch_hs(f"patch_hs_{i}", item, patch_input, generation_mode)
-          )
-      )
-    else:
-      # when patching a last-layer representation to the last layer of the same
-      # model, the final layer norm is not needed because it was already
-      # applied (assuming that the representation for patching was obtained by
-      # setting output_hidden_representations to True).
-      if skip_final_ln and i == len(model.transformer.h) - 1:
-        hooks.append(
-            model.transformer.ln_f.register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}_skip_ln",
-                    item,
-                    patch_input,
-                    generation_mode,
-                )
-            )
-        )
-      else:
-        hooks.append(
-            model.transformer.h[i].register_forward_hook(
-                patch_hs(f"patch_hs_{i}", item, patch_input, generation_mode)
-            )
-        )
-
-  return hooks
+  return set_hs_patch_hooks_batch(
+      model, hs_patch_config, module, patch_input, generation_mode
+  )
 
 
 def set_hs_patch_hooks_llama_batch(
@@ -709,162 +1003,380 @@ def set_hs_patch_hooks_llama_batch(
     generation_mode=False,
 ):
   """LLAMA patch hooks - supporting batch."""
-  # when using mode.generate() the hidden states in the input are cached after
-  # the first inference pass, and in the next steps the input/output are of
-  # size 1. In these cases we don't need to patch anymore the previous hidden
-  # states from the initial input, because they are cached, but we do need to
-  # handle these cases in this call because this hook wraps the generation call.
-  #
-  # NOTE: To use generation mode, we must patch a position that is not the
-  # first one. This is because in this case we don't know during generation if
-  # we are handling the initial input or a future step and thus don't know if
-  # a patching is needed or not.
-
-  # if generation_mode:
-  #     for i in hs_patch_config:
-  #         for position_, _ in hs_patch_config[i]:
-  #             assert position_ > 0
+  return set_hs_patch_hooks_batch(
+      model, hs_patch_config, module, patch_input, generation_mode
+  )
 
-  if module != "hs":
-    raise ValueError("Module %s not yet supported", module)
 
-  def patch_hs(name, position_hs, patch_input, generation_mode):
-    def pre_hook(module, inp):
-      # inp[0]: (batch, sequence, hidden_state)
-      idx_, position_, hs_ = (
-          position_hs["batch_idx"],
-          position_hs["position_target"],
-          position_hs["hidden_rep"],
-      )
-      input_len = len(inp[0][idx_])
-      if generation_mode and input_len == 1:
-        return
-      inp[0][idx_][position_] = hs_
-
-    def post_hook(module, inp, output):
-      idx_, position_, hs_ = (
-          position_hs["batch_idx"],
-          position_hs["position_target"],
-          position_hs["hidden_rep"],
-      )
-      if "skip_ln" in name:
-        # output: (batch, sequence, hidden_state)
-        output_len = len(output[idx_])
-        if generation_mode and output_len == 1:
-          return
-        output[idx_][position_] = hs_
-      else:
-        # output[0]: (batch, sequence, hidden_state)
-        output_len = len(output[0][idx_])
-        if generation_mode and output_len == 1:
-          return
-        output[0][idx_][position_] = hs_
+def set_hs_patch_hooks_neox_batch(
+    model,
+    hs_patch_config,
+    module="hs",
+    patch_input=False,
+    generation_mode=False,
+):
+  """Neox patch hooks - supporting batch."""
+  return set_hs_patch_hooks_batch(
+      model, hs_patch_config, module, patch_input, generation_mode
+  )
 
-    if patch_input:
-      return pre_hook
-    else:
-      return post_hook
 
-  hooks = []
+def _num_input_tokens(prepared):
+  """The number of prompt tokens of the model inputs of a prepared batch."""
+  if not isinstance(prepared, tuple):
+    return None
+  masks = [
+      inputs["attention_mask"]
+      for inputs in prepared
+      if isinstance(inputs, dict) and "attention_mask" in inputs
+  ]
+  if not masks:
+    return None
+  return int(sum(mask.sum() for mask in masks))
 
-  for item in hs_patch_config:
-    i = item["layer_target"]
-    skip_final_ln = item["skip_final_ln"]
-    if patch_input:
-      hooks.append(
-          model.model.layers[i].register_forward_pre_hook(
-              patch_hs(f"patch_hs_{i}", item, patch_input, generation_mode)
-          )
+
+def _run_batches(
+    run_single_batch,
+    df,
+    n_rows,
+    batch_size,
+    sink,
+    batches=None,
+    executor=None,
+    prepare_batch=None,
+    finish_batch=None,
+    progress=None,
+):
+  """Appends the results of each batch of df[:n_rows] to sink.
+
+  If `batches` (arrays of row positions, e.g. from `plan_length_batches`) is
+  given, the rows are evaluated in that order instead, and a "row" entry with
+  the position of each row in df is added to the results.
+
+  If `prepare_batch` is given, `run_single_batch(batch_df, prepared)` gets
+  its output, and if `finish_batch` is given, it gets the output of
+  `run_single_batch` and returns the results of the batch. The stages are
+  mapped over the batches by `executor` (a `pipeline_utils.SerialExecutor`
+  by default), which may overlap them across consecutive batches.
+
+  Progress and throughput are reported by `progress` (a
+  `general_utils.BatchProgress`), counting the prompt tokens of the model
+  inputs (dicts with an "attention_mask") that `prepare_batch` returns.
+  """
+  # Rows already in the sink (e.g. from an interrupted run) are skipped.
+  if batches is None:
+    rows = list(iter_batches(n_rows, batch_size, start=sink.num_rows))
+  else:
+    rows = []
+    num_rows = 0
+    for batch in batches:
+      num_rows += len(batch)
+      if num_rows > sink.num_rows:
+        rows.append(batch)
+
+  if executor is None:
+    executor = SerialExecutor()
+  if progress is None:
+    progress = BatchProgress()
+  run = run_single_batch
+  if prepare_batch is None:
+    prepare_batch = lambda batch_df: None
+    run = lambda batch_df, prepared: run_single_batch(batch_df)
+  if finish_batch is None:
+    finish_batch = lambda output: output
+
+  prepare_batch = wrap_stage("prepare_batch", prepare_batch)
+  run = wrap_stage("run_batch", run)
+  finish_batch = wrap_stage("finish_batch", finish_batch)
+
+  # Each batch is sliced from df in its prepare stage, so that only the
+  # batches in flight are copied, and its number of prompt tokens is passed
+  # along its stages.
+  def _prepare(batch):
+    batch_df = df.iloc[batch]
+    prepared = prepare_batch(batch_df)
+    return batch_df, prepared, _num_input_tokens(prepared)
+
+  def _run(batch, prepared):
+    batch_df, prepared, num_tokens = prepared
+    return run(batch_df, prepared), num_tokens
+
+  def _finish(output):
+    output, num_tokens = output
+    return finish_batch(output), num_tokens
+
+  all_results = executor.map(_prepare, _run, _finish, rows)
+  for batch, batch_results in zip(rows, progress.track(rows, all_results)):
+    if batches is not None:
+      batch_results["row"] = batch
+    sink.append(batch_results)
+  return sink.finalize()
+
+
+def _prepare_batch_inputs(mt, batch_df, tokenize_source=True, plan=None):
+  """Tokenizes the prompts of a batch and resolves its patch arrays.
+
+  Positions index the unpadded prompts, as in `cache_utils.HiddenStateCache`
+  (negative positions count from the end), and the inputs carry position ids
+  that ignore the left padding, so that the results of a row do not depend
+  on the other prompts of its batch.
+
+  Returns:
+    A tuple (inp_target, inp_source, batch), where batch holds the patch
+    arrays of the rows (see `plan_utils.resolve_patch_arrays`), with target
+    positions made absolute in inp_target, and source positions made absolute
+    in inp_source when the source prompts are tokenized. With `plan` (a
+    `plan_utils.PatchPlan` of the DataFrame), the inputs and arrays are read
+    from the plan rather than computed.
+  """
+  if plan is not None:
+    rows = plan.rows(batch_df)
+    with profile_span("make_inputs"):
+      inp_target = plan.make_inputs(
+          rows, "prompt_target", mt.device, mt.pin_memory
       )
-    else:
-      # when patching a last-layer representation to the last layer of the same
-      # model, the final layer norm is not needed because it was already applied
-      # (assuming that the representation for patching was obtained by setting
-      # output_hidden_representations to True).
-      if skip_final_ln and i == len(model.model.layers) - 1:
-        hooks.append(
-            model.model.norm.register_forward_hook(
-                patch_hs(
-                    f"patch_hs_{i}_skip_ln", item, patch_input, generation_mode
-                )
-            )
+      inp_source = None
+      if tokenize_source:
+        inp_source = plan.make_inputs(
+            rows, "prompt_source", mt.device, mt.pin_memory
         )
-      else:
-        hooks.append(
-            model.model.layers[i].register_forward_hook(
-                patch_hs(f"patch_hs_{i}", item, patch_input, generation_mode)
-            )
+    batch = plan.batch_arrays(rows)
+  else:
+    with profile_span("make_inputs"):
+      inp_target = make_inputs(
+          mt.tokenizer, batch_df["prompt_target"], mt.device, mt.pin_memory
+      )
+      inp_source = None
+      if tokenize_source:
+        inp_source = make_inputs(
+            mt.tokenizer, batch_df["prompt_source"], mt.device, mt.pin_memory
         )
+    batch = resolve_patch_arrays(batch_df, mt.num_layers)
+  batch["position_target"] = _padded_positions(
+      batch["position_target"], inp_target
+  )
+  inp_target["position_ids"] = _unpadded_position_ids(
+      inp_target["attention_mask"]
+  )
+  if inp_source is not None:
+    batch["position_source"] = _padded_positions(
+        batch["position_source"], inp_source
+    )
+    inp_source["position_ids"] = _unpadded_position_ids(
+        inp_source["attention_mask"]
+    )
+  return inp_target, inp_source, batch
 
-  return hooks
+
+def _restore_row_order(results):
+  """Sorts results collected over planned batches back into row order."""
+  order = np.argsort(results.pop("row", np.empty(0)), kind="stable")
+  return {key: value[order] for key, value in results.items()}
+
+
+def _batch_patch_config(mt, batch, hidden_rep, module):
+  """The columnar patch config that patches hidden_rep[i] into row i.
+
+  Args:
+    mt: the ModelAndTokenizer.
+    batch: the patch arrays of the batch, from `_prepare_batch_inputs`.
+    hidden_rep: the (batch, hidden_dim) representations to patch.
+    module: the patched module. With "attn_heads" and a "head" array in
+      batch, only the slice of each row's head is patched, unless all the
+      heads are -1 (the whole output is patched).
+
+  Returns:
+    A columnar patch config, see `_group_batch_patch_config`.
+  """
+  hs_patch_config = {
+      "batch_idx": np.arange(len(batch["layer_target"])),
+      "layer_target": batch["layer_target"],
+      "position_target": batch["position_target"],
+      "hidden_rep": hidden_rep,
+      "skip_final_ln": batch["skip_final_ln"],
+  }
+  if module == "attn_heads" and "head" in batch and (batch["head"] >= 0).any():
+    if (batch["head"] < 0).any():
+      raise ValueError("Rows of a batch must all patch a head, or none")
+    rows = torch.arange(len(hidden_rep), device=hidden_rep.device)
+    heads = torch.from_numpy(batch["head"]).to(hidden_rep.device)
+    hs_patch_config["head"] = batch["head"]
+    hs_patch_config["hidden_rep"] = hidden_rep.view(
+        len(hidden_rep), mt.components.num_heads, -1
+    )[rows, heads]
+  return hs_patch_config
+
+
+# The same model batch evaluators below take the following options, which
+# they document by reference.
+#
+# hs_cache: a `cache_utils.HiddenStateCache` to read the source hidden
+#   representations (and predictions) from, so that each unique source prompt
+#   is run through the model only once. Only supported with module "hs".
+# sink: e.g. a `results_utils.FileResultsSink`, to which the results of each
+#   batch are appended. The rows it already holds are skipped, and
+#   `sink.finalize()` is returned instead of the results.
+# max_batch_tokens: if given, rows are grouped into batches of similar prompt
+#   lengths (of at most `batch_size` rows) under that padded token budget,
+#   see `general_utils.plan_length_batches`. Returned results keep the row
+#   order of df, while a sink also receives the "row" of each result.
+# executor: e.g. a `pipeline_utils.ThreadedExecutor`, which tokenizes the
+#   next batches and decodes the previous ones while the model evaluates the
+#   current batch.
+# drop_last: whether to drop the last batch when it is shorter than
+#   batch_size, rather than evaluating all the rows of df.
+# progress: a `general_utils.BatchProgress` recording the throughput and the
+#   per-batch timings.
+# plan: a `plan_utils.PatchPlan` compiled from df, whose batches are evaluated
+#   instead of planning them from `batch_size`, `max_batch_tokens` and
+#   `drop_last`, and whose inputs and patch arrays are read for each batch.
+#
+# Positions index the unpadded prompts, see `_prepare_batch_inputs`.
 
 
 def evaluate_patch_next_token_prediction_batch(
-    mt, df, batch_size=256, transform=None, module="hs"
+    mt,
+    df,
+    batch_size=256,
+    transform=None,
+    module="hs",
+    hs_cache=None,
+    sink=None,
+    max_batch_tokens=None,
+    executor=None,
+    drop_last=False,
+    progress=None,
+    top_k=None,
+    plan=None,
 ):
-  """Evaluate next token prediction with batch support."""
-  if module != "hs":
+  """Evaluate next token prediction with batch support.
+
+  `module` is one of `BATCH_MODULES`: the hidden states ("hs"), the MLP or
+  attention outputs ("mlp", "attn"), or the per-head attention outputs
+  ("attn_heads"), of which only the heads listed in an optional "head" column
+  are patched. Results are returned as (prec_1, surprisal, next_token); see
+  above for `hs_cache`, `sink`, `max_batch_tokens`, `executor`, `drop_last`,
+  `progress` and `plan`.
+
+  If `top_k` is given, the logits are only computed at the source and
+  prediction positions (from their final layer norm outputs), and the
+  results also hold the "top_k_ids" and "top_k_logprobs" of the patched
+  distribution, and the "kl" divergence KL(original || patched), which are
+  returned as a dict rather than a tuple.
+  """
+  if module not in BATCH_MODULES:
     raise ValueError("Module %s not yet supported", module)
+  if hs_cache is not None and module != "hs":
+    raise ValueError("hs_cache only supports module hs")
+
+  def _evaluate_single_batch_top_k(batch_df, prepared):
+    batch_size = len(batch_df)
+    prompt_source_batch = np.array(batch_df["prompt_source"])
+    position_prediction_batch = -np.ones(batch_size, dtype=np.int64)
+    last_layer_batch = np.full(batch_size, mt.num_layers - 1)
+
+    inp_target, inp_source, batch = prepared
+    layer_source_batch = batch["layer_source"]
+    layer_target_batch = batch["layer_target"]
+    position_source_batch = batch["position_source"]
+
+    # first run the model on the source prompts, recording the residuals to
+    # patch and the final layer norm outputs to compute the original logits.
+    if hs_cache is not None:
+      logits_orig = hs_cache.get_logits(
+          prompt_source_batch, position_source_batch
+      )
+      hidden_rep = hs_cache.get_hidden_reps(
+          prompt_source_batch, layer_source_batch, position_source_batch
+      )
+    else:
+      reps, _ = mt.capture_hidden_reps(
+          np.concatenate([layer_source_batch, last_layer_batch]),
+          np.concatenate([position_source_batch, position_source_batch]),
+          batch_idx=np.tile(np.arange(batch_size), 2),
+          module=[module] * batch_size + ["hs"] * batch_size,
+          **inp_source,
+      )
+      hidden_rep = reps[:batch_size]
+      logits_orig = mt.components.unembedding(reps[batch_size:]).float()
+    if transform is not None:
+      hidden_rep = apply_transform(transform, hidden_rep)
+
+    # now do a second run on prompt, while patching the input hidden state.
+    hs_patch_config = _batch_patch_config(mt, batch, hidden_rep, module)
+    patch_hooks = set_hs_patch_hooks_batch(
+        mt.model,
+        hs_patch_config,
+        module=module,
+        patch_input=False,
+        generation_mode=False,
+    )
+    final_hs, _ = mt.capture_hidden_reps(
+        last_layer_batch, position_prediction_batch, **inp_target
+    )
+    logits = mt.components.unembedding(final_hs).float()
+
+    # remove patching hooks
+    remove_hooks(patch_hooks)
 
-  prec_1 = np.zeros(0)
-  surprisal = np.zeros(0)
-  next_token = np.zeros(0)
-  #     generations = []
+    logprobs_orig = torch.log_softmax(logits_orig, dim=-1)
+    logprobs = torch.log_softmax(logits, dim=-1).to(logprobs_orig.device)
+    answer_t_orig = logprobs_orig.argmax(dim=-1)
+    answer_t = logprobs.argmax(dim=-1)
+    top_k_logprobs, top_k_ids = logprobs.topk(top_k, dim=-1)
+    kl = (logprobs_orig.exp() * (logprobs_orig - logprobs)).sum(dim=-1)
+
+    return {
+        "prec_1": (answer_t == answer_t_orig).cpu().numpy(),
+        "surprisal": (
+            -logprobs_orig[np.arange(batch_size), answer_t].cpu().numpy()
+        ),
+        "answer_t": answer_t.cpu(),
+        "top_k_ids": top_k_ids.cpu().numpy(),
+        "top_k_logprobs": top_k_logprobs.cpu().numpy(),
+        "kl": kl.cpu().numpy(),
+    }
 
-  def _evaluat_single_batch(batch_df):
+  def _evaluat_single_batch(batch_df, prepared):
     batch_size = len(batch_df)
     prompt_source_batch = np.array(batch_df["prompt_source"])
-    prompt_target_batch = np.array(batch_df["prompt_target"])
-    layer_source_batch = np.array(batch_df["layer_source"])
-    layer_target_batch = np.array(batch_df["layer_target"])
-    position_source_batch = np.array(batch_df["position_source"])
-    position_target_batch = np.array(batch_df["position_target"])
-    position_prediction_batch = np.ones_like(position_target_batch) * -1
+    position_prediction_batch = -np.ones(batch_size, dtype=np.int64)
     #         max_gen_len = np.array(batch_df["max_gen_len"])
 
-    # adjust position_target to be absolute rather than relative
-    inp_target = make_inputs(mt.tokenizer, prompt_target_batch, mt.device)
-    for i in range(batch_size):
-      if position_target_batch[i] < 0:
-        position_target_batch[i] += len(inp_target["input_ids"][i])
+    inp_target, inp_source, batch = prepared
+    layer_source_batch = batch["layer_source"]
+    layer_target_batch = batch["layer_target"]
+    position_source_batch = batch["position_source"]
 
     # first run the the model on without patching and get the results.
-    inp_source = make_inputs(mt.tokenizer, prompt_source_batch, mt.device)
-    output_orig = mt.model(**inp_source, output_hidden_states=True)
-    dist_orig = torch.softmax(
-        output_orig.logits[
-            np.array(range(batch_size)), position_source_batch, :
-        ],
-        dim=-1,
-    )
+    if hs_cache is not None:
+      logits_orig = hs_cache.get_logits(
+          prompt_source_batch, position_source_batch
+      )
+      hidden_rep = hs_cache.get_hidden_reps(
+          prompt_source_batch, layer_source_batch, position_source_batch
+      )
+    else:
+      # Only the residual of each row at its (layer, position) is recorded,
+      # hidden_rep size (n_sample, hidden_dim)
+      hidden_rep, output_orig = mt.capture_hidden_reps(
+          layer_source_batch,
+          position_source_batch,
+          stop_early=False,
+          module=module,
+          **inp_source,
+      )
+      logits_orig = output_orig.logits[
+          np.array(range(batch_size)), position_source_batch, :
+      ]
+    dist_orig = torch.softmax(logits_orig, dim=-1)
     _, answer_t_orig = torch.max(dist_orig, dim=-1)
-    # hidden_states size (n_layers, n_sample, seq_len, hidden_dim)
-    hidden_rep = [
-        output_orig.hidden_states[layer_source_batch[i] + 1][i][
-            position_source_batch[i]
-        ]
-        for i in range(batch_size)
-    ]
     if transform is not None:
-      for i in range(batch_size):
-        hidden_rep[i] = transform(hidden_rep[i])
+      hidden_rep = apply_transform(transform, hidden_rep)
 
     # now do a second run on prompt, while patching the input hidden state.
-    hs_patch_config = [
-        {
-            "batch_idx": i,
-            "layer_target": layer_target_batch[i],
-            "position_target": position_target_batch[i],
-            "hidden_rep": hidden_rep[i],
-            "skip_final_ln": (
-                layer_source_batch[i]
-                == layer_target_batch[i]
-                == mt.num_layers - 1
-            ),
-        }
-        for i in range(batch_size)
-    ]
-    patch_hooks = mt.set_hs_patch_hooks(
+    hs_patch_config = _batch_patch_config(mt, batch, hidden_rep, module)
+    patch_hooks = set_hs_patch_hooks_batch(
         mt.model,
         hs_patch_config,
         module=module,
@@ -898,7 +1410,6 @@ def evaluate_patch_next_token_prediction_batch(
         dim=-1,
     )
     _, answer_t = torch.max(dist, dim=-1)
-    next_token = [mt.tokenizer.decode(tok) for tok in answer_t]
 
     # remove patching hooks
     remove_hooks(patch_hooks)
@@ -911,109 +1422,350 @@ def evaluate_patch_next_token_prediction_batch(
         .numpy()
     )
 
-    return prec_1, surprisal, next_token
+    return {
+        "prec_1": prec_1,
+        "surprisal": surprisal,
+        "answer_t": answer_t.detach().cpu(),
+    }
 
-  for i in tqdm.tqdm(range(len(df) // batch_size)):
-    cur_df = df.iloc[batch_size * i : batch_size * (i + 1)]
-    batch_prec_1, batch_surprisal, batch_next_token = _evaluat_single_batch(
-        cur_df
+  def _finish_batch(results):
+    # Decoding runs on the host, possibly while the next batch is evaluated.
+    results["next_token"] = [
+        mt.tokenizer.decode(tok) for tok in results.pop("answer_t")
+    ]
+    return results
+
+  n_rows = len(df) - (len(df) % batch_size if drop_last else 0)
+  batches = None
+  if max_batch_tokens is not None:
+    batches = plan_length_batches(
+        mt.tokenizer, df.iloc[:n_rows], max_batch_tokens, max_rows=batch_size
+    )
+  if plan is not None:
+    plan.check(df)
+    n_rows, batches = plan.num_rows, plan.batches
+  stages = dict(
+      executor=executor,
+      progress=progress or BatchProgress(),
+      prepare_batch=lambda batch_df: _prepare_batch_inputs(
+          mt, batch_df, tokenize_source=hs_cache is None, plan=plan
+      ),
+      finish_batch=_finish_batch,
+  )
+  evaluate_single_batch = _evaluat_single_batch
+  if top_k is not None:
+    evaluate_single_batch = _evaluate_single_batch_top_k
+  if sink is not None:
+    return _run_batches(
+        evaluate_single_batch, df, n_rows, batch_size, sink, batches, **stages
     )
-    prec_1 = np.concatenate((prec_1, batch_prec_1))
-    surprisal = np.concatenate((surprisal, batch_surprisal))
-    next_token = np.concatenate((next_token, batch_next_token))
 
-  return prec_1, surprisal, next_token
+  keys = ("prec_1", "surprisal", "next_token")
+  if top_k is not None:
+    keys += ("top_k_ids", "top_k_logprobs", "kl")
+  results = _run_batches(
+      evaluate_single_batch,
+      df,
+      n_rows,
+      batch_size,
+      ArrayResultsSink(n_rows, keys),
+      batches,
+      **stages,
+  )
+  if batches is not None:
+    results = _restore_row_order(results)
+  if top_k is not None:
+    results["prec_1"] = results["prec_1"].astype(float)
+    return results
+  return (
+      results["prec_1"].astype(float),
+      results["surprisal"],
+      results["next_token"],
+  )
 
 
-def inspect_batch(mt, df, batch_size=256, transform=None, module="hs"):
-  """Inspects batch: source/target layer/position could differ within batch."""
-  if module != "hs":
-    raise ValueError("Module %s not yet supported", module)
+def evaluate_quantization_fidelity(
+    mt, mt_quantized, df, sample_size=256, batch_size=32, seed=0
+):
+  """Compares next token prediction of a quantized model to the float one.
+
+  Runs `evaluate_patch_next_token_prediction_batch` with both models on the
+  same random sample of the rows of df.
+
+  Args:
+    mt: the float ModelAndTokenizer.
+    mt_quantized: the quantized ModelAndTokenizer, e.g. with quantize="int8".
+    df: a DataFrame with the columns of the batch evaluator.
+    sample_size: the number of rows to sample.
+    batch_size: the batch size of the evaluator.
+    seed: the seed of the sample.
+
+  Returns:
+    A dict with the mean prec@1 and surprisal of each model, the rate at
+    which both models predict the same patched next token, and the mean
+    absolute difference between their surprisals.
+  """
+  sample_size = min(sample_size, len(df))
+  sample_df = df.sample(n=sample_size, random_state=seed)
+  prec_1, surprisal, next_token = evaluate_patch_next_token_prediction_batch(
+      mt, sample_df, batch_size=batch_size
+  )
+  prec_1_q, surprisal_q, next_token_q = (
+      evaluate_patch_next_token_prediction_batch(
+          mt_quantized, sample_df, batch_size=batch_size
+      )
+  )
+  return {
+      "num_rows": sample_size,
+      "prec_1": prec_1.mean(),
+      "prec_1_quantized": prec_1_q.mean(),
+      "surprisal": surprisal.mean(),
+      "surprisal_quantized": surprisal_q.mean(),
+      "next_token_agreement": (next_token == next_token_q).mean(),
+      "surprisal_abs_diff": np.abs(surprisal - surprisal_q).mean(),
+  }
+
 
-  generations = []
+def evaluate_patch_next_token_prediction_x_model_batch(
+    mt_1,
+    mt_2,
+    df,
+    batch_size=256,
+    transform=None,
+    module="hs",
+    sink=None,
+):
+  """Evaluate next token prediction across models with batch support.
+
+  Source prompts are run through mt_1 and their residuals are patched into
+  the target prompts run through mt_2, as in
+  `evaluate_patch_next_token_prediction_x_model`. Positions (including the
+  optional "position_prediction" column, -1 by default) index into the
+  unpadded prompts, as in the single row evaluator.
+
+  If `transform` is given, it is applied with `apply_transform`, so a batched
+  transform (e.g. a learned affine map) is a single matmul over the batch,
+  and the rows of a batch typically share (layer_source, layer_target).
+
+  Results are returned as (prec_1, surprisal), unless a `sink` is given, as
+  in `evaluate_patch_next_token_prediction_batch`.
+  """
+  if module not in BATCH_MODULES:
+    raise ValueError("Module %s not yet supported", module)
 
-  def _inspect_single_batch(batch_df):
+  def _evaluate_single_batch(batch_df):
     batch_size = len(batch_df)
-    prompt_source_batch = np.array(batch_df["prompt_source"])
-    prompt_target_batch = np.array(batch_df["prompt_target"])
-    layer_source_batch = np.array(batch_df["layer_source"])
-    layer_target_batch = np.array(batch_df["layer_target"])
-    position_source_batch = np.array(batch_df["position_source"])
-    position_target_batch = np.array(batch_df["position_target"])
-    max_gen_len = np.array(batch_df["max_gen_len"])
+    if "position_prediction" in batch_df:
+      position_prediction_batch = np.array(batch_df["position_prediction"])
+    else:
+      position_prediction_batch = -np.ones(batch_size, dtype=np.int64)
 
-    # adjust position_target to be absolute rather than relative
-    inp_target = make_inputs(mt.tokenizer, prompt_target_batch, mt.device)
-    for i in range(batch_size):
-      if position_target_batch[i] < 0:
-        position_target_batch[i] += len(inp_target["input_ids"][i])
+    inp_source = make_inputs(
+        mt_1.tokenizer,
+        list(batch_df["prompt_source"]),
+        mt_1.device,
+        mt_1.pin_memory,
+    )
+    inp_target = make_inputs(
+        mt_2.tokenizer,
+        list(batch_df["prompt_target"]),
+        mt_2.device,
+        mt_2.pin_memory,
+    )
+    position_source_batch = _padded_positions(
+        np.array(batch_df["position_source"]), inp_source
+    )
+    position_target_batch = _padded_positions(
+        np.array(batch_df["position_target"]), inp_target
+    )
+    position_prediction_batch = _padded_positions(
+        position_prediction_batch, inp_target
+    )
 
-    # first run the the model on without patching and get the results.
-    inp_source = make_inputs(mt.tokenizer, prompt_source_batch, mt.device)
-    output_orig = mt.model(**inp_source, output_hidden_states=True)
-
-    # hidden_states size (n_layers, n_sample, seq_len, hidden_dim)
-    hidden_rep = [
-        output_orig.hidden_states[layer_source_batch[i] + 1][i][
-            position_source_batch[i]
-        ]
-        for i in range(batch_size)
-    ]
+    # first run mt_1 on the source prompts and get the results.
+    hidden_rep, output_orig = mt_1.capture_hidden_reps(
+        np.array(batch_df["layer_source"]),
+        position_source_batch,
+        stop_early=False,
+        module=module,
+        position_ids=_unpadded_position_ids(inp_source["attention_mask"]),
+        **inp_source,
+    )
+    dist_orig = torch.softmax(
+        output_orig.logits[np.arange(batch_size), position_source_batch, :],
+        dim=-1,
+    )
+    _, answer_t_orig = torch.max(dist_orig, dim=-1)
+    hidden_rep = hidden_rep.to(mt_2.device)
     if transform is not None:
-      for i in range(batch_size):
-        hidden_rep[i] = transform(hidden_rep[i])
+      hidden_rep = apply_transform(transform, hidden_rep)
 
-    # now do a second run on prompt, while patching the input hidden state.
+    # now run mt_2 on the target prompts, while patching the hidden states.
     hs_patch_config = [
         {
             "batch_idx": i,
-            "layer_target": layer_target_batch[i],
+            "layer_target": layer_target,
             "position_target": position_target_batch[i],
             "hidden_rep": hidden_rep[i],
-            "skip_final_ln": (
-                layer_source_batch[i]
-                == layer_target_batch[i]
-                == mt.num_layers - 1
-            ),
+            "skip_final_ln": False,
         }
-        for i in range(batch_size)
+        for i, layer_target in enumerate(batch_df["layer_target"])
     ]
-    patch_hooks = mt.set_hs_patch_hooks(
-        mt.model,
+    patch_hooks = set_hs_patch_hooks_batch(
+        mt_2.model,
         hs_patch_config,
         module=module,
         patch_input=False,
-        generation_mode=True,
+        generation_mode=False,
+    )
+    output = mt_2.model(
+        position_ids=_unpadded_position_ids(inp_target["attention_mask"]),
+        **inp_target,
     )
+    dist = torch.softmax(
+        output.logits[np.arange(batch_size), position_prediction_batch, :],
+        dim=-1,
+    )
+    _, answer_t = torch.max(dist, dim=-1)
+
+    # remove patching hooks
+    remove_hooks(patch_hooks)
+
+    answer_t = answer_t.to(answer_t_orig.device)
+    prec_1 = (answer_t == answer_t_orig).detach().cpu().numpy()
+    surprisal = (
+        -torch.log(dist_orig[np.arange(batch_size), answer_t])
+        .detach()
+        .cpu()
+        .numpy()
+    )
+    return {"prec_1": prec_1, "surprisal": surprisal}
+
+  n_rows = len(df)
+  if sink is not None:
+    return _run_batches(_evaluate_single_batch, df, n_rows, batch_size, sink)
+
+  results = _run_batches(
+      _evaluate_single_batch,
+      df,
+      n_rows,
+      batch_size,
+      ArrayResultsSink(n_rows, ("prec_1", "surprisal")),
+  )
+  return results["prec_1"].astype(float), results["surprisal"]
+
+
+def inspect_batch(
+    mt,
+    df,
+    batch_size=256,
+    transform=None,
+    module="hs",
+    hs_cache=None,
+    max_batch_tokens=None,
+    prefix_cache=None,
+    executor=None,
+    drop_last=False,
+    progress=None,
+    plan=None,
+):
+  """Inspects batch: source/target layer/position could differ within batch.
+
+  If `prefix_cache` (a `cache_utils.PrefixKVCache`) is given, the key/values
+  of the target prompt tokens that a batch shares before its earliest
+  patched position are computed once and reused across batches. See above
+  for `hs_cache`, `max_batch_tokens`, `executor`, `drop_last`, `progress` and
+  `plan`.
+  """
+  if module not in BATCH_MODULES:
+    raise ValueError("Module %s not yet supported", module)
+  if hs_cache is not None and module != "hs":
+    raise ValueError("hs_cache only supports module hs")
+
+  def _inspect_single_batch(batch_df, prepared):
+    batch_size = len(batch_df)
+    prompt_source_batch = np.array(batch_df["prompt_source"])
+    prompt_target_batch = np.array(batch_df["prompt_target"])
+    max_gen_len = np.array(batch_df["max_gen_len"])
+
+    inp_target, inp_source, batch = prepared
+    layer_source_batch = batch["layer_source"]
+    layer_target_batch = batch["layer_target"]
+    position_source_batch = batch["position_source"]
 
-    # NOTE: inputs are left padded,
-    # and sequence length is the same across batch
-    # to support generations of variable lengths,
-    # first generate with maximum number of tokens needed in the batch
-    seq_len = len(inp_target["input_ids"][0])
-    output_toks = mt.model.generate(
-        inp_target["input_ids"],
-        max_length=seq_len + max(max_gen_len),
-        pad_token_id=mt.model.generation_config.eos_token_id,
-    )[:, seq_len:]
+    # first run the the model on without patching and get the results.
+    if hs_cache is not None:
+      hidden_rep = hs_cache.get_hidden_reps(
+          prompt_source_batch, layer_source_batch, position_source_batch
+      )
+    else:
+      # Only the residual of each row at its (layer, position) is recorded,
+      # and layers after the deepest source layer of the batch are skipped.
+      # hidden_rep size (n_sample, hidden_dim)
+      hidden_rep, _ = mt.capture_hidden_reps(
+          layer_source_batch,
+          position_source_batch,
+          module=module,
+          **inp_source,
+      )
+    if transform is not None:
+      hidden_rep = apply_transform(transform, hidden_rep)
 
+    # now do a second run on prompt, while patching the input hidden state.
+    hs_patch_config = _batch_patch_config(mt, batch, hidden_rep, module)
+    # NOTE: inputs are left padded, the patches only apply to the prompt
+    # tokens, and each row stops at its own max_gen_len (or EOS).
+    if prefix_cache is not None:
+      output_toks = _generate_with_prefix_cache(
+          mt,
+          prefix_cache,
+          prompt_target_batch,
+          hs_patch_config,
+          max_gen_len,
+          module=module,
+      )
+    else:
+      output_toks = generate_patched(
+          mt, inp_target, hs_patch_config, max_gen_len, module=module
+      )
+
+    return output_toks.cpu(), max_gen_len
+
+  def _finish_batch(output):
+    output_toks, max_gen_len = output
     # then, we select only the subset of tokens that we need
     generations = [
         mt.tokenizer.decode(output_toks[i][: max_gen_len[i]])
-        for i in range(batch_size)
+        for i in range(len(output_toks))
     ]
+    return {"generations": generations}
 
-    # remove patching hooks
-    remove_hooks(patch_hooks)
-
-    return generations
-
-  for i in tqdm.tqdm(range(1 + len(df) // batch_size)):
-    cur_df = df.iloc[batch_size * i : batch_size * (i + 1)]
-    batch_generations = _inspect_single_batch(cur_df)
-    generations.extend(batch_generations)
-
-  return generations
+  n_rows = len(df) - (len(df) % batch_size if drop_last else 0)
+  batches = None
+  if max_batch_tokens is not None:
+    batches = plan_length_batches(
+        mt.tokenizer, df.iloc[:n_rows], max_batch_tokens, max_rows=batch_size
+    )
+  if plan is not None:
+    plan.check(df)
+    n_rows, batches = plan.num_rows, plan.batches
+  results = _run_batches(
+      _inspect_single_batch,
+      df,
+      n_rows,
+      batch_size,
+      ArrayResultsSink(n_rows, ("generations",)),
+      batches,
+      executor=executor,
+      progress=progress or BatchProgress(),
+      prepare_batch=lambda batch_df: _prepare_batch_inputs(
+          mt, batch_df, tokenize_source=hs_cache is None, plan=plan
+      ),
+      finish_batch=_finish_batch,
+  )
+  if batches is not None:
+    results = _restore_row_order(results)
+  return results["generations"].tolist()
 
 
 def evaluate_attriburte_exraction_batch(
@@ -1024,83 +1776,75 @@ def evaluate_attriburte_exraction_batch(
     transform=None,
     is_icl=True,
     module="hs",
+    hs_cache=None,
+    sink=None,
+    max_batch_tokens=None,
+    executor=None,
+    drop_last=False,
+    progress=None,
+    plan=None,
 ):
-  """Evaluates attribute extraction with batch support."""
+  """Evaluates attribute extraction with batch support.
+
+  Results are returned as a dict of arrays; see above for `hs_cache`, `sink`,
+  `executor`, `drop_last`, `progress` and `plan`. With `max_batch_tokens`,
+  the batches also share their prefix when `is_icl`.
+  """
   # We don't know the exact token position of the
   # attribute, as it is not necessarily the next token. So, precision and
   # surprisal may not apply directly.
 
-  if module != "hs":
+  if module not in BATCH_MODULES:
     raise ValueError("Module %s not yet supported", module)
+  if hs_cache is not None and module != "hs":
+    raise ValueError("hs_cache only supports module hs")
 
-  def _evaluate_attriburte_exraction_single_batch(batch_df):
+  def _evaluate_attriburte_exraction_single_batch(batch_df, prepared):
     batch_size = len(batch_df)
     prompt_source_batch = np.array(batch_df["prompt_source"])
-    prompt_target_batch = np.array(batch_df["prompt_target"])
-    layer_source_batch = np.array(batch_df["layer_source"])
-    layer_target_batch = np.array(batch_df["layer_target"])
-    position_source_batch = np.array(batch_df["position_source"])
-    position_target_batch = np.array(batch_df["position_target"])
 
-    object_batch = np.array(batch_df["object"])
-
-    # Adjust position_target to be absolute rather than relative
-    inp_target = make_inputs(mt.tokenizer, prompt_target_batch, mt.device)
-    for i in range(batch_size):
-      if position_target_batch[i] < 0:
-        position_target_batch[i] += len(inp_target["input_ids"][i])
+    inp_target, inp_source, batch = prepared
+    layer_source_batch = batch["layer_source"]
+    layer_target_batch = batch["layer_target"]
+    position_source_batch = batch["position_source"]
 
     # Step 1: run model on source prompt without patching and get the hidden
     # representations.
-    inp_source = make_inputs(mt.tokenizer, prompt_source_batch, mt.device)
-    output_orig = mt.model(**inp_source, output_hidden_states=True)
-
-    # hidden_states size (n_layers, n_sample, seq_len, hidden_dim)
-    #         hidden_rep = []
-    #         for i in range(batch_size):
-    #             hidden_rep.append(output_orig.hidden_states[layer_source_batch[i] + 1][i][position_source_batch[i]])
-    hidden_rep = [
-        output_orig.hidden_states[layer_source_batch[i] + 1][i][
-            position_source_batch[i]
-        ]
-        for i in range(batch_size)
-    ]
+    if hs_cache is not None:
+      hidden_rep = hs_cache.get_hidden_reps(
+          prompt_source_batch, layer_source_batch, position_source_batch
+      )
+    else:
+      # Only the residual of each row at its (layer, position) is recorded,
+      # and layers after the deepest source layer of the batch are skipped.
+      # hidden_rep size (n_sample, hidden_dim)
+      hidden_rep, _ = mt.capture_hidden_reps(
+          layer_source_batch,
+          position_source_batch,
+          module=module,
+          **inp_source,
+      )
     if transform is not None:
-      for i in range(batch_size):
-        hidden_rep[i] = transform(hidden_rep[i])
+      hidden_rep = apply_transform(transform, hidden_rep)
 
     # Step 2: Do second run on target prompt, while patching the input
     # hidden state.
-    hs_patch_config = [
-        {
-            "batch_idx": i,
-            "layer_target": layer_target_batch[i],
-            "position_target": position_target_batch[i],
-            "hidden_rep": hidden_rep[i],
-            "skip_final_ln": (
-                layer_source_batch[i]
-                == layer_target_batch[i]
-                == mt.num_layers - 1
-            ),
-        }
-        for i in range(batch_size)
-    ]
-    patch_hooks = mt.set_hs_patch_hooks(
-        mt.model,
-        hs_patch_config,
-        module=module,
-        patch_input=False,
-        generation_mode=True,
+    hs_patch_config = _batch_patch_config(mt, batch, hidden_rep, module)
+    # Note that inputs are left padded, and the patches only apply to the
+    # prompt tokens.
+    output_toks = generate_patched(
+        mt, inp_target, hs_patch_config, max_gen_len, module=module
+    )
+
+    cpu_hidden_rep = np.array(
+        [hidden_rep[i].detach().cpu().numpy() for i in range(batch_size)]
     )
+    return batch_df, output_toks.cpu(), cpu_hidden_rep
 
-    # Note that inputs are left padded,
-    # and sequence length is the same across batch
-    seq_len = len(inp_target["input_ids"][0])
-    output_toks = mt.model.generate(
-        inp_target["input_ids"],
-        max_length=seq_len + max_gen_len,
-        pad_token_id=mt.model.generation_config.eos_token_id,
-    )[:, seq_len:]
+  def _finish_batch(output):
+    batch_df, output_toks, cpu_hidden_rep = output
+    batch_size = len(batch_df)
+    object_batch = np.array(batch_df["object"])
     generations_patched = decode_tokens(mt.tokenizer, output_toks)
     if is_icl:
       prefix = batch_df["prefix"].iloc[0]
@@ -1125,13 +1869,6 @@ def evaluate_attriburte_exraction_batch(
         for i in range(batch_size)
     ])
 
-    # remove patching hooks
-    remove_hooks(patch_hooks)
-
-    cpu_hidden_rep = np.array(
-        [hidden_rep[i].detach().cpu().numpy() for i in range(batch_size)]
-    )
-
     results = {
         "generations_patched": generations_patched,
         "generations_patched_postprocessed": generations_patched_postprocessed,
@@ -1141,17 +1878,55 @@ def evaluate_attriburte_exraction_batch(
 
     return results
 
-  results = {}
-  n_batches = len(df) // batch_size
-  if len(df) % batch_size != 0:
-    n_batches += 1
-  for i in tqdm(range(len(df) // batch_size)):
-    cur_df = df.iloc[batch_size * i : batch_size * (i + 1)]
-    batch_results = _evaluate_attriburte_exraction_single_batch(cur_df)
-    for key, value in batch_results.items():
-      if key in results:
-        results[key] = np.concatenate((results[key], value))
-      else:
-        results[key] = value
+  n_rows = len(df) - (len(df) % batch_size if drop_last else 0)
+  batches = None
+  if max_batch_tokens is not None:
+    batches = plan_length_batches(
+        mt.tokenizer,
+        df.iloc[:n_rows],
+        max_batch_tokens,
+        max_rows=batch_size,
+        group_by=("prefix",) if is_icl else (),
+    )
+  if plan is not None:
+    plan.check(df, group_by=("prefix",) if is_icl else ())
+    n_rows, batches = plan.num_rows, plan.batches
+  stages = dict(
+      executor=executor,
+      progress=progress or BatchProgress(),
+      prepare_batch=lambda batch_df: _prepare_batch_inputs(
+          mt, batch_df, tokenize_source=hs_cache is None, plan=plan
+      ),
+      finish_batch=_finish_batch,
+  )
+  if sink is not None:
+    return _run_batches(
+        _evaluate_attriburte_exraction_single_batch,
+        df,
+        n_rows,
+        batch_size,
+        sink,
+        batches,
+        **stages,
+    )
 
+  results = _run_batches(
+      _evaluate_attriburte_exraction_single_batch,
+      df,
+      n_rows,
+      batch_size,
+      ArrayResultsSink(
+          n_rows,
+          (
+              "generations_patched",
+              "generations_patched_postprocessed",
+              "is_correct_patched",
+              "hidden_rep",
+          ),
+      ),
+      batches,
+      **stages,
+  )
+  if batches is not None:
+    results = _restore_row_order(results)
   return results
@@ -0,0 +1,98 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of patchscopes_utils on tiny randomly initialized models."""
+
+import unittest
+
+from benchmark import make_tiny_mt
+from general_utils import make_inputs
+from patchscopes_utils import inspect
+from patchscopes_utils import remove_hooks
+from patchscopes_utils import set_hs_patch_hooks
+import torch
+
+_ARCHS = ("gptj", "llama", "neox")
+_PROMPT_SOURCE = "w1 w2 w3 w4 w5 w6"
+_PROMPT_TARGET = "w7 w8 w9 w10"
+
+
+def _baseline_inspect(
+    mt, layer_source, layer_target, position_source, position_target,
+    max_gen_len,
+):
+  """`inspect` as it read all the hidden states of the source prompt."""
+  inp_target = make_inputs(mt.tokenizer, [_PROMPT_TARGET], mt.device)
+  seq_len = len(inp_target["input_ids"][0])
+  if position_target < 0:
+    position_target = seq_len + position_target
+  inp_source = make_inputs(mt.tokenizer, [_PROMPT_SOURCE], mt.device)
+  output = mt.model(**inp_source, output_hidden_states=True)
+  hidden_rep = output.hidden_states[layer_source + 1][0][position_source]
+  patch_hooks = set_hs_patch_hooks(
+      mt.model,
+      {layer_target: [(position_target, hidden_rep)]},
+      skip_final_ln=layer_source == layer_target == mt.num_layers - 1,
+      generation_mode=True,
+  )
+  output_toks = mt.model.generate(
+      inp_target["input_ids"],
+      max_length=seq_len + max_gen_len,
+      pad_token_id=mt.model.generation_config.eos_token_id,
+  )[0][seq_len:]
+  remove_hooks(patch_hooks)
+  return mt.tokenizer.decode(output_toks)
+
+
+class ForwardToLayerTest(unittest.TestCase):
+
+  def test_matches_output_hidden_states(self):
+    for arch in _ARCHS:
+      mt = make_tiny_mt(arch)
+      inp = make_inputs(mt.tokenizer, [_PROMPT_SOURCE], mt.device)
+      expected = mt.model(**inp, output_hidden_states=True).hidden_states
+      for layer in range(mt.num_layers):
+        hidden_states = mt.forward_to_layer(layer, **inp)
+        self.assertEqual(len(hidden_states), layer + 2, arch)
+        for actual, reference in zip(hidden_states, expected):
+          torch.testing.assert_close(actual, reference)
+
+
+class InspectTest(unittest.TestCase):
+
+  def test_gptj_matches_baseline(self):
+    mt = make_tiny_mt("gptj")
+    mt.set_hs_patch_hooks = set_hs_patch_hooks
+    for layer_source in range(mt.num_layers):
+      for position_source in (1, -1):
+        output = inspect(
+            mt,
+            _PROMPT_SOURCE,
+            _PROMPT_TARGET,
+            layer_source,
+            1,
+            position_source,
+            -1,
+            generation_mode=True,
+            max_gen_len=5,
+        )
+        self.assertEqual(
+            output,
+            _baseline_inspect(mt, layer_source, 1, position_source, -1, 5),
+        )
+
+
+if __name__ == "__main__":
+  unittest.main()
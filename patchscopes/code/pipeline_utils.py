@@ -0,0 +1,79 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Execution backends that run the stages of the batch evaluators.
+
+Each batch goes through three stages: `prepare` (host side, e.g. tokenizing
+and padding the prompts), `run` (the forward passes on the model's device)
+and `finish` (host side, e.g. decoding the generations). An executor maps
+the stages over a sequence of batches and yields the finished results in
+order.
+"""
+
+import collections
+import concurrent.futures
+
+
+class SerialExecutor:
+  """Runs the stages of each batch one after the other."""
+
+  def map(self, prepare, run, finish, batches):
+    for batch in batches:
+      yield finish(run(batch, prepare(batch)))
+
+
+class ThreadedExecutor:
+  """Overlaps the host side stages with the forward passes.
+
+  While the calling thread runs batch N, a pool of `num_prepare_workers`
+  threads prepares the next `prefetch` batches, and a pool of
+  `num_finish_workers` threads finishes the previous ones. Tokenizers and
+  most torch operations release the GIL, so the accelerator is kept busy.
+  """
+
+  def __init__(self, num_prepare_workers=1, num_finish_workers=1, prefetch=1):
+    self.num_prepare_workers = num_prepare_workers
+    self.num_finish_workers = num_finish_workers
+    self.prefetch = prefetch
+
+  def map(self, prepare, run, finish, batches):
+    batches = iter(batches)
+    with concurrent.futures.ThreadPoolExecutor(
+        self.num_prepare_workers
+    ) as prepare_pool, concurrent.futures.ThreadPoolExecutor(
+        self.num_finish_workers
+    ) as finish_pool:
+      prepared = collections.deque()
+      finished = collections.deque()
+
+      def submit_prepare():
+        for batch in batches:
+          prepared.append((batch, prepare_pool.submit(prepare, batch)))
+          return
+
+      for _ in range(1 + self.prefetch):
+        submit_prepare()
+      while prepared:
+        batch, inputs = prepared.popleft()
+        submit_prepare()
+        finished.append(
+            finish_pool.submit(finish, run(batch, inputs.result()))
+        )
+        while finished and (
+            finished[0].done() or len(finished) > self.num_finish_workers
+        ):
+          yield finished.popleft().result()
+      while finished:
+        yield finished.popleft().result()
@@ -0,0 +1,268 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Patch plans: the per-row work of a sweep, compiled to numpy arrays."""
+
+import numpy as np
+import pandas as pd
+from general_utils import encode_prompts
+from general_utils import get_pad_id
+from general_utils import iter_batches
+from general_utils import pad_inputs
+from general_utils import plan_length_batches
+from sweep_utils import batch_fingerprint
+
+# The columns of a patchscopes DataFrame that a plan holds as arrays.
+PLAN_COLUMNS = ("layer_source", "layer_target", "position_source",
+                "position_target")
+# The columns whose contents a plan is checked against, when present.
+_FINGERPRINT_COLUMNS = ("prompt_source", "prompt_target") + PLAN_COLUMNS + (
+    "head", "prefix")
+
+
+def resolve_patch_arrays(df, num_layers):
+  """The patch arrays of the rows of df, with one entry per row.
+
+  Args:
+    df: a patchscopes DataFrame, with the `PLAN_COLUMNS` and optionally a
+      "head" column.
+    num_layers: the number of layers of the model.
+
+  Returns:
+    A dict mapping each of `PLAN_COLUMNS`, "skip_final_ln" (whether a row
+    patches a last layer representation into the last layer) and "head", if
+    in df, to an array. Positions are the ones of df, in the unpadded
+    prompts.
+  """
+  arrays = {
+      column: np.asarray(df[column], dtype=np.int64)
+      for column in PLAN_COLUMNS
+  }
+  arrays["skip_final_ln"] = (
+      arrays["layer_source"] == arrays["layer_target"]
+  ) & (arrays["layer_target"] == num_layers - 1)
+  if "head" in df:
+    arrays["head"] = np.asarray(df["head"], dtype=np.int64)
+  return arrays
+
+
+class PatchPlan:
+  """The tokens, patch arrays and batches of a sweep over a DataFrame.
+
+  `PatchPlan.compile` tokenizes each unique prompt of the DataFrame once,
+  resolves the patch arrays of all the rows (see `resolve_patch_arrays`) and
+  plans the batches up front. Given a plan, the batch evaluators build the
+  inputs of each batch from the stored tokens and read its patch arrays by
+  slicing, so no prompts are encoded and no per-row Python runs in the
+  batch loop. Plans can be saved and loaded to reuse them across runs, with
+  the same DataFrame and tokenizer.
+  """
+
+  def __init__(
+      self,
+      index,
+      arrays,
+      tokens,
+      token_offsets,
+      prompt_ids,
+      batches,
+      pad_id,
+      fingerprint,
+      max_batch_tokens=None,
+      group_by=(),
+  ):
+    self.index = pd.Index(index)
+    self.arrays = arrays
+    self.tokens = tokens
+    self.token_offsets = token_offsets
+    self.prompt_ids = prompt_ids
+    self.batches = batches
+    self.pad_id = pad_id
+    self.fingerprint = fingerprint
+    self.max_batch_tokens = max_batch_tokens
+    self.group_by = tuple(group_by)
+
+  @classmethod
+  def compile(
+      cls,
+      mt,
+      df,
+      batch_size,
+      max_batch_tokens=None,
+      drop_last=False,
+      group_by=(),
+  ):
+    """Compiles the plan of df for mt.
+
+    Args:
+      mt: the ModelAndTokenizer.
+      df: a patchscopes DataFrame, with a unique index.
+      batch_size: the number of rows of each batch.
+      max_batch_tokens: if given, rows are grouped into batches of similar
+        prompt lengths (of at most `batch_size` rows) under that padded token
+        budget, see `general_utils.plan_length_batches`.
+      drop_last: whether to drop the last batch when it is shorter than
+        batch_size.
+      group_by: the columns whose values are the same within planned
+        batches, e.g. ("prefix",), which the in-context attribute extraction
+        requires when max_batch_tokens is given.
+
+    Returns:
+      A PatchPlan.
+    """
+    if not df.index.is_unique:
+      raise ValueError("The index of df must be unique")
+    n_rows = len(df) - (len(df) % batch_size if drop_last else 0)
+    if max_batch_tokens is not None:
+      batches = plan_length_batches(
+          mt.tokenizer,
+          df.iloc[:n_rows],
+          max_batch_tokens,
+          max_rows=batch_size,
+          group_by=group_by,
+      )
+    else:
+      batches = list(iter_batches(n_rows, batch_size))
+
+    # Each unique prompt is tokenized once, and its tokens are stored in
+    # the flat tokens array.
+    columns = ("prompt_source", "prompt_target")
+    prompts, inverse = np.unique(
+        np.concatenate([np.asarray(df[c], dtype=object) for c in columns]),
+        return_inverse=True,
+    )
+    token_lists = encode_prompts(mt.tokenizer, prompts)
+    lengths = np.array([len(t) for t in token_lists], dtype=np.int64)
+    tokens = np.fromiter(
+        (t for token_list in token_lists for t in token_list),
+        dtype=np.int64,
+        count=lengths.sum(),
+    )
+    return cls(
+        df.index,
+        resolve_patch_arrays(df, mt.num_layers),
+        tokens,
+        np.concatenate([[0], np.cumsum(lengths)]),
+        dict(zip(columns, np.split(inverse, len(columns)))),
+        [np.asarray(batch, dtype=np.int64) for batch in batches],
+        get_pad_id(mt.tokenizer),
+        batch_fingerprint(df, _FINGERPRINT_COLUMNS),
+        max_batch_tokens,
+        group_by,
+    )
+
+  @property
+  def num_rows(self):
+    """The number of rows that the batches of the plan cover."""
+    return sum(len(batch) for batch in self.batches)
+
+  def check(self, df, group_by=()):
+    """Raises a ValueError if the plan was not compiled from df.
+
+    Args:
+      df: the DataFrame to evaluate with the plan.
+      group_by: the columns whose values must be the same within each batch,
+        when the batches are planned by prompt length.
+    """
+    if not self.index.equals(df.index) or self.fingerprint != (
+        batch_fingerprint(df, _FINGERPRINT_COLUMNS)
+    ):
+      raise ValueError("The plan was compiled from a different DataFrame")
+    missing = set(group_by) - set(self.group_by)
+    if self.max_batch_tokens is not None and missing:
+      raise ValueError(
+          "The plan must be compiled with group_by including %s"
+          % sorted(missing)
+      )
+
+  def rows(self, batch_df):
+    """The positions in the planned DataFrame of the rows of batch_df."""
+    return self.index.get_indexer(batch_df.index)
+
+  def make_inputs(self, rows, column, device="cuda", pin_memory=False):
+    """The inputs of the prompts in column of rows, see `make_inputs`."""
+    prompt_ids = self.prompt_ids[column][rows]
+    starts = self.token_offsets[prompt_ids]
+    lengths = self.token_offsets[prompt_ids + 1] - starts
+    # The token positions of each prompt, one prompt after the other.
+    token_idx = np.arange(lengths.sum()) + np.repeat(
+        starts - (np.cumsum(lengths) - lengths), lengths
+    )
+    return pad_inputs(
+        self.tokens[token_idx], lengths, self.pad_id, device, pin_memory
+    )
+
+  def batch_arrays(self, rows):
+    """The patch arrays of rows, see `resolve_patch_arrays`."""
+    return {name: array[rows] for name, array in self.arrays.items()}
+
+  def save(self, path):
+    """Saves the plan to path, in the numpy .npz format."""
+    np.savez(
+        path,
+        index=np.asarray(self.index),
+        tokens=self.tokens,
+        token_offsets=self.token_offsets,
+        batch_rows=np.concatenate(
+            self.batches + [np.zeros(0, dtype=np.int64)]
+        ),
+        batch_lengths=np.array([len(b) for b in self.batches], dtype=np.int64),
+        pad_id=self.pad_id,
+        fingerprint=self.fingerprint,
+        max_batch_tokens=(
+            -1 if self.max_batch_tokens is None else self.max_batch_tokens
+        ),
+        group_by=np.array(self.group_by, dtype=str),
+        **{"array_" + name: array for name, array in self.arrays.items()},
+        **{
+            "prompt_ids_" + column: ids
+            for column, ids in self.prompt_ids.items()
+        },
+    )
+
+  @classmethod
+  def load(cls, path):
+    """Loads a plan saved by `save`.
+
+    An index of objects (e.g. strings) is unpickled, so only load plans from
+    trusted sources.
+    """
+    with np.load(path, allow_pickle=True) as data:
+      batch_ends = np.cumsum(data["batch_lengths"])
+      return cls(
+          data["index"],
+          {
+              key[len("array_"):]: data[key]
+              for key in data.files
+              if key.startswith("array_")
+          },
+          data["tokens"],
+          data["token_offsets"],
+          {
+              key[len("prompt_ids_"):]: data[key]
+              for key in data.files
+              if key.startswith("prompt_ids_")
+          },
+          [
+              data["batch_rows"][end - length:end]
+              for end, length in zip(batch_ends, data["batch_lengths"])
+          ],
+          int(data["pad_id"]),
+          str(data["fingerprint"]),
+          None if data["max_batch_tokens"] < 0 else int(
+              data["max_batch_tokens"]
+          ),
+          tuple(str(c) for c in data["group_by"]),
+      )
@@ -0,0 +1,191 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in timing of the patch and record hooks and of the batch stages.
+
+Within `with HookProfiler() as profiler:`, the hooks registered by
+`set_hs_patch_hooks_batch` and `ModelAndTokenizer.capture_hidden_reps`, the
+prepare/run/finish stages of the batch evaluators, and the tokenization and
+generation steps are timed. Outside of it, hooks and stages are registered
+unwrapped, so profiling costs nothing when disabled.
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# The HookProfiler that is recording, if any.
+_ACTIVE_PROFILER = None
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class HookProfiler:
+  """Records the calls, durations and written bytes of hooks and stages.
+
+  `report()` aggregates the events by name, and `chrome_trace()` exports them
+  in the Chrome trace event format (for chrome://tracing or Perfetto).
+  """
+
+  def __init__(self):
+    self.events = []
+    self._lock = threading.Lock()
+    self._start_time = None
+    self._previous = None
+
+  def __enter__(self):
+    global _ACTIVE_PROFILER
+    self._previous = _ACTIVE_PROFILER
+    if self._start_time is None:
+      self._start_time = time.perf_counter()
+    _ACTIVE_PROFILER = self
+    return self
+
+  def __exit__(self, *exc_info):
+    global _ACTIVE_PROFILER
+    _ACTIVE_PROFILER = self._previous
+    self._previous = None
+
+  def record(self, name, category, start_time, end_time, bytes_written=0):
+    """Adds an event with perf_counter start and end times."""
+    with self._lock:
+      self.events.append((
+          name,
+          category,
+          start_time,
+          end_time,
+          bytes_written,
+          threading.get_ident(),
+      ))
+
+  def report(self):
+    """Returns a dict mapping each event name to its aggregated counters.
+
+    Each entry holds the "category" ("hook" or "stage"), the number of
+    "calls", the "total_ms" and "mean_ms" durations and the total
+    "bytes_written" (by hooks, into the hidden states or capture buffers).
+    """
+    totals = collections.defaultdict(
+        lambda: dict(category=None, calls=0, total_ms=0.0, bytes_written=0)
+    )
+    with self._lock:
+      events = list(self.events)
+    for name, category, start_time, end_time, bytes_written, _ in events:
+      entry = totals[name]
+      entry["category"] = category
+      entry["calls"] += 1
+      entry["total_ms"] += (end_time - start_time) * 1000
+      entry["bytes_written"] += bytes_written
+    for entry in totals.values():
+      entry["mean_ms"] = entry["total_ms"] / entry["calls"]
+    return dict(sorted(totals.items(), key=lambda kv: -kv[1]["total_ms"]))
+
+  def chrome_trace(self, path=None):
+    """Returns the events in the Chrome trace format, and writes to path."""
+    pid = os.getpid()
+    with self._lock:
+      events = list(self.events)
+    trace = {
+        "traceEvents": [
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start_time - self._start_time) * 1e6,
+                "dur": (end_time - start_time) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {"bytes_written": bytes_written},
+            }
+            for name, category, start_time, end_time, bytes_written, tid in (
+                events
+            )
+        ],
+        "displayTimeUnit": "ms",
+    }
+    if path is not None:
+      with open(path, "w") as f:
+        json.dump(trace, f)
+    return trace
+
+
+def profiling_enabled():
+  """Whether a HookProfiler is recording."""
+  return _ACTIVE_PROFILER is not None
+
+
+def _wrap(name, category, fn, bytes_written):
+  profiler = _ACTIVE_PROFILER
+  if profiler is None:
+    return fn
+
+  @functools.wraps(fn)
+  def profiled(*args, **kwargs):
+    start_time = time.perf_counter()
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      profiler.record(
+          name, category, start_time, time.perf_counter(), bytes_written
+      )
+
+  return profiled
+
+
+def wrap_hook(name, hook, bytes_written=0):
+  """Times hook in the recording profiler, or returns it if there is none.
+
+  Args:
+    name: the name of the hook in the report, e.g. "patch/hs/12".
+    hook: a forward hook or forward pre-hook.
+    bytes_written: the number of bytes that each call of hook writes.
+
+  Returns:
+    The hook to register.
+  """
+  return _wrap(name, "hook", hook, bytes_written)
+
+
+def wrap_stage(name, fn):
+  """Times fn in the recording profiler, or returns it if there is none."""
+  return _wrap(name, "stage", fn, 0)
+
+
+def profile_span(name):
+  """A context manager that times its body in the recording profiler."""
+  profiler = _ACTIVE_PROFILER
+  if profiler is None:
+    return _NULL_SPAN
+  return _Span(profiler, name)
+
+
+class _Span:
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+    self.start_time = None
+
+  def __enter__(self):
+    self.start_time = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.profiler.record(
+        self.name, "stage", self.start_time, time.perf_counter()
+    )
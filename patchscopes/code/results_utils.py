@@ -0,0 +1,157 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental sinks for the results of the batch evaluators.
+
+A sink receives the results of each batch as a dict of arrays (one entry per
+row of the batch) through `append`, and `num_rows` tells the evaluators how
+many rows were already written, so that an interrupted sweep can resume from
+the last flushed batch.
+"""
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ArrayResultsSink:
+  """Collects batch results into arrays preallocated for all rows.
+
+  The `keys` of the results are returned as empty arrays by `finalize` when
+  no batch was appended, e.g. when df has fewer rows than a batch.
+  """
+
+  def __init__(self, num_rows, keys=()):
+    self.num_rows_total = num_rows
+    self.num_rows = 0
+    self.keys = tuple(keys)
+    self._arrays = {}
+
+  def append(self, batch_results):
+    batch_len = None
+    for key, value in batch_results.items():
+      value = np.asarray(value)
+      if key not in self._arrays:
+        # Strings are kept as objects until finalize, as their width may grow.
+        dtype = object if value.dtype.kind in "US" else value.dtype
+        self._arrays[key] = np.empty(
+            (self.num_rows_total,) + value.shape[1:], dtype=dtype
+        )
+      self._arrays[key][self.num_rows : self.num_rows + len(value)] = value
+      batch_len = len(value)
+    self.num_rows += batch_len or 0
+
+  def finalize(self):
+    """Returns a dict with the arrays of the rows written so far."""
+    results = {}
+    for key, value in self._arrays.items():
+      value = value[: self.num_rows]
+      is_str = [isinstance(v, str) for v in value.flat]
+      if value.dtype == object and all(is_str):
+        value = value.astype(str)
+      results[key] = value
+    for key in self.keys:
+      results.setdefault(key, np.empty(0))
+    return results
+
+
+class FileResultsSink:
+  """Streams batch results to numbered part files in a directory.
+
+  Batches are buffered until at least `rows_per_part` rows are pending, and
+  then written atomically as one Parquet (or CSV) part file, so that memory
+  stays bounded and a crashed run can resume from the last flushed part.
+  Parquet requires `pyarrow`, and CSV only supports one value per row and
+  column (not e.g. `hidden_rep`).
+  """
+
+  def __init__(self, path, file_format="parquet", rows_per_part=1):
+    if file_format not in ("parquet", "csv"):
+      raise ValueError("Unsupported file format %s" % file_format)
+    self.path = path
+    self.file_format = file_format
+    self.rows_per_part = rows_per_part
+    os.makedirs(path, exist_ok=True)
+    # Part files are named after the range of rows they hold.
+    parts = _part_files(path, file_format)
+    self.num_rows = 0
+    if parts:
+      self.num_rows = int(os.path.basename(parts[-1]).split(".")[0][-9:])
+    self._pending = []
+    self._num_pending = 0
+
+  def append(self, batch_results):
+    columns = {}
+    for key, value in batch_results.items():
+      value = np.asarray(value)
+      if value.ndim > 1:
+        if self.file_format == "csv":
+          raise ValueError("Column %s has more than one value per row" % key)
+        value = list(value)
+      columns[key] = value
+    batch_df = pd.DataFrame(columns)
+    self._pending.append(batch_df)
+    self._num_pending += len(batch_df)
+    if self._num_pending >= self.rows_per_part:
+      self.flush()
+
+  def flush(self):
+    if not self._pending:
+      return
+    part_df = pd.concat(self._pending, ignore_index=True)
+    end = self.num_rows + len(part_df)
+    path = os.path.join(
+        self.path, f"part-{self.num_rows:09d}-{end:09d}.{self.file_format}"
+    )
+    if self.file_format == "parquet":
+      part_df.to_parquet(path + ".tmp", engine="pyarrow", index=False)
+    else:
+      part_df.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    self.num_rows = end
+    self._pending = []
+    self._num_pending = 0
+
+  def finalize(self):
+    """Flushes the pending rows and returns the results directory."""
+    self.flush()
+    return self.path
+
+
+def _part_files(path, file_format):
+  return sorted(glob.glob(os.path.join(path, f"part-*.{file_format}")))
+
+
+def _read_part(path, file_format):
+  if file_format == "parquet":
+    return pd.read_parquet(path, engine="pyarrow")
+  return pd.read_csv(path, keep_default_na=False)
+
+
+def load_results(path, file_format="parquet"):
+  """Loads the results written by a `FileResultsSink` as a dict of arrays."""
+  df = pd.concat(
+      [_read_part(f, file_format) for f in _part_files(path, file_format)],
+      ignore_index=True,
+  )
+  results = {}
+  for key in df.columns:
+    value = df[key].to_numpy()
+    if len(value) and isinstance(value[0], np.ndarray):
+      value = np.stack(value)
+    results[key] = value
+  return results
@@ -0,0 +1,353 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resumable sweeps of the patchscopes batch evaluators over DataFrames."""
+
+import collections
+import functools
+import hashlib
+import multiprocessing
+import os
+import pickle
+import queue
+import traceback
+import types
+
+import numpy as np
+import pandas as pd
+import torch
+import tqdm
+from general_utils import iter_batches
+from general_utils import model_id
+
+
+# Columns that define a patchscopes sweep row, when present in the DataFrame.
+SWEEP_COLUMNS = (
+    "prompt_source",
+    "prompt_target",
+    "layer_source",
+    "layer_target",
+    "position_source",
+    "position_target",
+    "max_gen_len",
+    "object",
+    "prefix",
+    "head",
+    "position_prediction",
+)
+# Evaluator arguments that change the outputs of a sweep, when given.
+SWEEP_KWARGS = ("module", "transform", "top_k", "max_gen_len", "is_icl")
+
+
+def batch_fingerprint(batch_df, columns=SWEEP_COLUMNS, kwargs=None, model=None):
+  """Returns a hash of the rows of a batch and of what they are evaluated with.
+
+  Args:
+    batch_df: the rows of the batch.
+    columns: the columns of batch_df to hash, when present.
+    kwargs: the arguments of the evaluator, of which the `SWEEP_KWARGS` are
+      hashed. Modules and tensors (e.g. transforms) are hashed by their
+      contents, and functions by their name and the values they close over.
+    model: the `general_utils.model_id` of the model that evaluates the
+      batch.
+
+  Returns:
+    A hex digest of 16 characters.
+  """
+  columns = [c for c in columns if c in batch_df.columns]
+  row_hashes = pd.util.hash_pandas_object(
+      batch_df[columns].astype(str), index=False
+  )
+  digest = hashlib.sha1(row_hashes.to_numpy().tobytes())
+  for key in SWEEP_KWARGS:
+    if kwargs and key in kwargs:
+      digest.update(f"{key}={_describe_kwarg(kwargs[key])};".encode())
+  if model is not None:
+    digest.update(f"model={model};".encode())
+  return digest.hexdigest()[:16]
+
+
+def _describe_kwarg(value, depth=0):
+  """A description of an evaluator argument that changes with its contents."""
+  if depth > 4:
+    return type(value).__qualname__
+  describe = lambda v: _describe_kwarg(v, depth + 1)
+  if isinstance(value, torch.nn.Module):
+    return "%s(%s)" % (
+        type(value).__qualname__,
+        describe(list(value.state_dict().items())),
+    )
+  if isinstance(value, torch.Tensor):
+    value = value.detach().cpu()
+    if value.is_quantized:
+      value = value.dequantize()
+    if value.is_floating_point():
+      value = value.float()
+    value = value.numpy()
+  if isinstance(value, np.ndarray):
+    return "%s%s:%s" % (
+        value.dtype,
+        value.shape,
+        hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest(),
+    )
+  if isinstance(value, (list, tuple)):
+    return "[%s]" % ",".join(describe(v) for v in value)
+  if isinstance(value, functools.partial):
+    return "partial(%s)" % describe(
+        [value.func, value.args, sorted(value.keywords.items())]
+    )
+  if callable(value):
+    parts = [
+        "%s.%s" % (
+            getattr(value, "__module__", None),
+            getattr(value, "__qualname__", type(value).__qualname__),
+        )
+    ]
+    if isinstance(value, types.MethodType):
+      parts.append(value.__self__)
+    for cell in getattr(value, "__closure__", None) or ():
+      try:
+        parts.append(cell.cell_contents)
+      except ValueError:  # an empty cell
+        pass
+    if not isinstance(value, (types.FunctionType, types.MethodType)) and (
+        hasattr(value, "__dict__")
+    ):
+      parts.append(sorted(vars(value).items()))
+    return describe(parts)
+  return repr(value)
+
+
+def merge_batch_outputs(outputs):
+  """Concatenates the outputs of a batch evaluator over consecutive batches.
+
+  Args:
+    outputs: a list of outputs of the same evaluator, each being a list, an
+      array, a dict of arrays or a tuple of arrays.
+
+  Returns:
+    The merged output, with the same structure as each of the outputs.
+  """
+  first = outputs[0]
+  if isinstance(first, dict):
+    return {
+        key: merge_batch_outputs([output[key] for output in outputs])
+        for key in first
+    }
+  if isinstance(first, tuple):
+    return tuple(
+        merge_batch_outputs([output[i] for output in outputs])
+        for i in range(len(first))
+    )
+  if isinstance(first, list):
+    return [x for output in outputs for x in output]
+  return np.concatenate(outputs)
+
+
+class SweepRunner:
+  """Runs a batch evaluator over a sweep DataFrame, one stored batch at a time.
+
+  Each batch of `batch_size` consecutive rows gets a stable id made of its
+  index and a fingerprint of its rows, and its output is pickled to
+  `store_dir` once it completes. Running the same sweep again (e.g. after a
+  preemption) loads the finished batches from the store and only evaluates
+  the missing ones.
+  """
+
+  def __init__(self, store_dir, batch_size=256):
+    self.store_dir = store_dir
+    self.batch_size = batch_size
+    os.makedirs(store_dir, exist_ok=True)
+
+  def batches(self, df, mt=None, **kwargs):
+    """Yields (batch_id, batch_df) for the consecutive batches of df.
+
+    The ids also depend on the model of `mt` and on the evaluator arguments
+    in `SWEEP_KWARGS`, so that e.g. a sweep with another model, module or
+    transform does not reuse the outputs in the store.
+    """
+    model = None if mt is None else model_id(mt.model)
+    for i, rows in enumerate(iter_batches(len(df), self.batch_size)):
+      batch_df = df.iloc[rows]
+      fingerprint = batch_fingerprint(batch_df, kwargs=kwargs, model=model)
+      yield f"{i:06d}-{fingerprint}", batch_df
+
+  def _path(self, batch_id):
+    return os.path.join(self.store_dir, f"batch-{batch_id}.pkl")
+
+  def is_done(self, batch_id):
+    return os.path.exists(self._path(batch_id))
+
+  def run(self, evaluate_fn, mt, df, **kwargs):
+    """Runs `evaluate_fn` over all batches of df and merges their outputs.
+
+    Args:
+      evaluate_fn: a batch evaluator, e.g. `inspect_batch` or
+        `evaluate_patch_next_token_prediction_batch`, called as
+        `evaluate_fn(mt, batch_df, batch_size=len(batch_df), **kwargs)`.
+      mt: the ModelAndTokenizer to evaluate.
+      df: the sweep DataFrame.
+      **kwargs: further arguments of `evaluate_fn`.
+
+    Returns:
+      The outputs of all batches, merged in row order.
+    """
+    batches = list(self.batches(df, mt, **kwargs))
+    n_done = sum(self.is_done(batch_id) for batch_id, _ in batches)
+    for batch_id, batch_df in tqdm.tqdm(
+        batches, initial=n_done, total=len(batches)
+    ):
+      if self.is_done(batch_id):
+        continue
+      output = evaluate_fn(mt, batch_df, batch_size=len(batch_df), **kwargs)
+      path = self._path(batch_id)
+      with open(path + ".tmp", "wb") as f:
+        pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(path + ".tmp", path)
+
+    outputs = []
+    for batch_id, _ in batches:
+      with open(self._path(batch_id), "rb") as f:
+        outputs.append(pickle.load(f))
+    return merge_batch_outputs(outputs)
+
+
+def _sweep_worker(
+    make_mt, evaluate_fn, kwargs, num_threads, worker_id, tasks, results
+):
+  """Evaluates the chunks assigned to the worker until it gets None."""
+  if num_threads is not None:
+    torch.set_num_threads(num_threads)
+  mt = make_mt()
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    chunk_id, chunk_df = task
+    try:
+      output = evaluate_fn(mt, chunk_df, batch_size=len(chunk_df), **kwargs)
+      results.put((worker_id, chunk_id, "done", output))
+    except Exception:
+      results.put((worker_id, chunk_id, "error", traceback.format_exc()))
+
+
+class ShardedSweepExecutor:
+  """Runs a batch evaluator over a sweep DataFrame in parallel processes.
+
+  The rows of df are split into chunks of `batch_size` consecutive rows that
+  `num_workers` processes, each with its own ModelAndTokenizer replica (built
+  by calling `make_mt`, e.g. `functools.partial(ModelAndTokenizer,
+  model_name, device="cpu")`) and `num_threads` torch threads (by default,
+  an even share of the CPUs), evaluate. The parent assigns one chunk at a
+  time to each idle worker, so it knows the chunk of a worker that dies.
+  Outputs are merged back in row order. A chunk whose evaluation raises, or
+  whose worker dies, is requeued for the other workers up to `max_retries`
+  times.
+  """
+
+  def __init__(
+      self, make_mt, num_workers=2, batch_size=256, num_threads=None,
+      max_retries=1,
+  ):
+    self.make_mt = make_mt
+    self.num_workers = num_workers
+    self.batch_size = batch_size
+    if num_threads is None:
+      # Workers would otherwise each use all the CPUs, oversubscribing them.
+      num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    self.num_threads = num_threads
+    self.max_retries = max_retries
+
+  def run(self, evaluate_fn, df, **kwargs):
+    """Runs `evaluate_fn` over all chunks of df and merges their outputs.
+
+    Args:
+      evaluate_fn: a module level batch evaluator, e.g. `inspect_batch`,
+        called as `evaluate_fn(mt, chunk_df, batch_size=len(chunk_df),
+        **kwargs)`.
+      df: the sweep DataFrame.
+      **kwargs: further (picklable) arguments of `evaluate_fn`.
+
+    Returns:
+      The outputs of all chunks, merged in row order.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    chunks = {
+        i: df.iloc[rows]
+        for i, rows in enumerate(iter_batches(len(df), self.batch_size))
+    }
+    tasks = [ctx.Queue() for _ in range(self.num_workers)]
+    workers = [
+        ctx.Process(
+            target=_sweep_worker,
+            args=(
+                self.make_mt, evaluate_fn, kwargs, self.num_threads,
+                worker_id, tasks[worker_id], results,
+            ),
+            daemon=True,
+        )
+        for worker_id in range(self.num_workers)
+    ]
+    for worker in workers:
+      worker.start()
+
+    outputs = {}
+    pending = collections.deque(chunks)
+    assigned = {}  # worker_id -> chunk_id
+    retries = {chunk_id: 0 for chunk_id in chunks}
+
+    def assign():
+      for worker_id, worker in enumerate(workers):
+        if pending and worker_id not in assigned and worker.is_alive():
+          chunk_id = pending.popleft()
+          assigned[worker_id] = chunk_id
+          tasks[worker_id].put((chunk_id, chunks[chunk_id]))
+
+    def requeue(chunk_id, reason):
+      retries[chunk_id] += 1
+      if retries[chunk_id] > self.max_retries:
+        raise RuntimeError("Chunk %d failed: %s" % (chunk_id, reason))
+      pending.append(chunk_id)
+
+    try:
+      with tqdm.tqdm(total=len(chunks)) as progress:
+        assign()
+        while len(outputs) < len(chunks):
+          try:
+            worker_id, chunk_id, status, value = results.get(timeout=1)
+          except queue.Empty:
+            for worker_id, worker in enumerate(workers):
+              if not worker.is_alive() and worker_id in assigned:
+                requeue(assigned.pop(worker_id), "worker died")
+            if not any(worker.is_alive() for worker in workers):
+              raise RuntimeError("All sweep workers died")
+            assign()
+            continue
+          assigned.pop(worker_id, None)
+          if status == "error":
+            requeue(chunk_id, value)
+          elif chunk_id not in outputs:
+            outputs[chunk_id] = value
+            progress.update(1)
+          assign()
+    finally:
+      for worker_tasks in tasks:
+        worker_tasks.put(None)
+      for worker in workers:
+        worker.join(timeout=10)
+        if worker.is_alive():
+          worker.terminate()
+    return merge_batch_outputs([outputs[i] for i in sorted(outputs)])
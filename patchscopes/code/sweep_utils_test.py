@@ -0,0 +1,67 @@
+# coding=utf-8
+# Copyright 2024 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the resumable sweeps."""
+
+import tempfile
+import unittest
+
+from benchmark import make_benchmark_df
+from benchmark import make_tiny_mt
+import numpy as np
+from sweep_utils import SweepRunner
+import torch
+
+
+def _transform_evaluator(mt, batch_df, batch_size, transform):
+  del mt, batch_size
+  with torch.no_grad():
+    return transform(torch.ones(len(batch_df), 4)).numpy()
+
+
+class SweepRunnerTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.mt = make_tiny_mt("gptj")
+    self.df = make_benchmark_df(self.mt, n_rows=6, seq_len=4)
+
+  def test_different_transforms_do_not_share_results(self):
+    torch.manual_seed(0)
+    transforms = [torch.nn.Linear(4, 4), torch.nn.Linear(4, 4)]
+    with tempfile.TemporaryDirectory() as store_dir:
+      runner = SweepRunner(store_dir, batch_size=4)
+      for transform in transforms:
+        output = runner.run(
+            _transform_evaluator, self.mt, self.df, transform=transform
+        )
+        np.testing.assert_allclose(
+            output,
+            _transform_evaluator(None, self.df, None, transform),
+        )
+
+  def test_different_models_do_not_share_batch_ids(self):
+    runner = SweepRunner(tempfile.gettempdir(), batch_size=4)
+    other_mt = make_tiny_mt("gptj", seed=1)
+    self.assertTrue(
+        set(batch_id for batch_id, _ in runner.batches(self.df, self.mt))
+        .isdisjoint(
+            batch_id for batch_id, _ in runner.batches(self.df, other_mt)
+        )
+    )
+
+
+if __name__ == "__main__":
+  unittest.main()